@@ -4,7 +4,7 @@
 import sys
 from subprocess import Popen
 import random
-from mynet import ListenSocket, Event, Timer
+from mynet import ListenSocket, Event, Timer, Stats
 
 class Peer:
 	# status flags
@@ -79,13 +79,13 @@ class Daemon:
 		self.clients.discard(socket) # just in case
 
 	def on_data(self, socket, data):
-		pos = data.find('\n')
+		pos = socket.find_line()
 		if pos < 0: # need to wait for new line
 			return 0
 		elif pos == 0:
 			return 1 # just a keep-alive
 
-		args = data[0:pos].split(' ')
+		args = data[0:pos].tobytes().split(' ')
 
 		# possible messages (peer)
 		# HELLO host -- peer is now active and ready to be started
@@ -112,6 +112,7 @@ class Daemon:
 		# CSTART host -- request to start host
 		# CSTOP host -- request to stop host
 		# CKILL host -- request to kill host
+		# STATS -- event loop statistics, one STAT line each, ending with STAT end
 		elif args[0] == 'CHELLO' and len(args) == 1:
 			for i in self.peers.values():
 				socket.write(i.get_state())
@@ -122,6 +123,9 @@ class Daemon:
 			self.do_stop(args[1])
 		elif args[0] == 'CKILL' and len(args) == 2:
 			self.do_kill(args[1])
+		elif args[0] == 'STATS' and len(args) == 1:
+			for i in Stats.report():
+				socket.write(i)
 		else:
 			print 'unknown message:', ' '.join(args)
 
@@ -1,14 +1,22 @@
 # management layer for connecting to central server
+import os
 import random
+import signal
 import socket
 import sys
 from mynet import ListenSocket, DgramSocket, StreamSocket, Timer, Event
 
 class Manager:
-	def __init__(self, client, host, server):
+	# workers -- number of extra processes to fork on START that share the
+	# listen port (only if the client asks for the 'workers' option)
+	def __init__(self, client, host, server, workers=0):
 		self.client = client
 		self.host = host
 		self.server = server
+		self.workers = workers
+		if self.workers:
+			# let the kernel reap workers when they exit
+			signal.signal(signal.SIGCHLD, signal.SIG_IGN)
 
 		self.options = client.options()
 		self.socket = StreamSocket(socket.socket(), self)
@@ -22,13 +30,13 @@ class Manager:
 		sys.exit('lost connection to server')
 
 	def on_data(self, socket, data):
-		pos = data.find('\n')
+		pos = socket.find_line()
 		if pos < 0: # need to wait for new line
 			return 0
 		elif pos == 0:
 			return 1 # just a keep-alive
 
-		args = data[0:pos].split(' ')
+		args = data[0:pos].tobytes().split(' ')
 
 		# possible messages:
 		# KILL -- terminate self
@@ -49,6 +57,10 @@ class Manager:
 		port = random.randrange(10000, 65536)
 		opts = {}
 
+		# fork workers first, so they don't inherit the sockets we make below
+		if self.workers and 'workers' in self.options:
+			opts['worker_socks'] = self.spawn_workers(port)
+
 		# set up datagram socket
 		if 'dgram_socket' in self.options:
 			dgram_socket = DgramSocket(port, self.client)
@@ -56,7 +68,7 @@ class Manager:
 
 		# set up server socket
 		if 'listen_sock' in self.options:
-			server_socket = ListenSocket(port, self.client)
+			server_socket = ListenSocket(port, self.client, 'worker_socks' in opts)
 			opts['listen_sock'] = server_socket
 
 		if 'boot_peer' in self.options and bootstrap != 'none':
@@ -68,6 +80,39 @@ class Manager:
 
 		self.socket.write(['STARTED', self.host, str(port)])
 
+	# fork off worker processes. each gets one end of a socketpair to talk to
+	# us (the coordinator) over; we return our ends for the client to wrap
+	def spawn_workers(self, port):
+		sys.stdout.flush() # or the child will print our buffered output again
+		socks = []
+		for i in range(self.workers):
+			(mine, theirs) = socket.socketpair()
+			if os.fork() == 0:
+				# close everything of the parent's we inherited, so it sees
+				# EOF on its channels when other workers exit
+				for s in socks + [mine, self.socket.socket]:
+					s.close()
+				self.run_worker(port, theirs)
+			theirs.close()
+			socks.append(mine)
+		return socks
+
+	# body of a worker process; never returns
+	def run_worker(self, port, chan):
+		try:
+			Event.reset()
+			worker = self.client.make_worker()
+			opts = {}
+			opts['coord_sock'] = StreamSocket(chan, worker)
+			opts['listen_sock'] = ListenSocket(port, worker, True)
+			opts['listen_addr'] = '%s:%d' % (self.host, port)
+			worker.start(opts)
+			Event.dispatch()
+		finally:
+			# don't unwind into the parent's stack that we were forked from
+			sys.stdout.flush()
+			os._exit(0)
+
 	def do_stop(self):
 		self.client.stop()
 		self.socket.write(['STOPPED', self.host])
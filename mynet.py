@@ -1,64 +1,382 @@
 # classes for providing event handling and socket buffering abstractions
 # I've already written the same thing in C++ and Java for classes I already took;
 # why isn't this part of the standard library??
+import base64
+import errno
+import heapq
+import itertools
+import os
+import select
 import socket
+import struct
 import sys
-from select import select
+import weakref
+from collections import deque
 from time import time
 
 DEBUG = False
 
+# errors from a non-blocking send that just mean "try again later"
+SEND_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOTCONN, errno.EINPROGRESS)
+# gather writes, if the platform has them (python 2 doesn't); otherwise we
+# send one pending buffer at a time
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+IOV_MAX = 64 # max number of buffers to hand sendmsg at once
+# python 2's socket module doesn't know about SO_REUSEPORT; 15 is linux's value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# optional instrumentation for the event loop. turned on by setting the
+# MYNET_STATS environment variable to 1 (or calling Stats.enable() before any
+# sockets are made); when it's off, each hook costs a single attribute test.
+# records:
+# cb.<Owner>.<method> -- time spent in client callbacks (on_data, on_dgram, timers)
+# timer.lag -- how late timers fire
+# poll.wait -- time spent waiting in select/epoll
+# and reports current buffer depths of StreamSockets and DgramSockets
+class Stats:
+	enabled = os.environ.get('MYNET_STATS') == '1'
+	hists = {} # name -> Histogram
+	streams = weakref.WeakSet() # live StreamSockets
+	dgrams = weakref.WeakSet() # live DgramSockets
+
+	@staticmethod
+	def enable():
+		Stats.enabled = True
+
+	@staticmethod
+	def record(name, secs):
+		if name not in Stats.hists:
+			Stats.hists[name] = Histogram()
+		Stats.hists[name].add(secs)
+
+	# call fn(*args), recording how long it took under its owner and name
+	@staticmethod
+	def call(fn, *args):
+		start = time()
+		try:
+			return fn(*args)
+		finally:
+			Stats.record('cb.' + cb_name(fn), time() - start)
+
+	# list of lines (lists of words) describing everything we know
+	@staticmethod
+	def report():
+		ret = [['STAT', 'enabled', str(int(Stats.enabled))]]
+		for name in sorted(Stats.hists.iterkeys()):
+			ret.append(['STAT', name] + Stats.hists[name].report())
+		for s in Stats.streams:
+			if s.closed:
+				continue
+			ret.append(['STAT', 'stream', str(s), 'rbuf=%d' % (s.rend - s.rstart), 'wbuf=%d' % s.wlen,
+				'paused=%d' % s.paused])
+		for s in Stats.dgrams:
+			ret.append(['STAT', 'dgram', '%x' % id(s), 'sendq=%d' % len(s.sendq),
+				'pkts_in=%d' % s.pkts_in, 'bytes_in=%d' % s.bytes_in,
+				'pkts_out=%d' % s.pkts_out, 'bytes_out=%d' % s.bytes_out,
+				'drops=%d' % s.drops, 'rerrors=%d' % s.rerrors])
+		ret.append(['STAT', 'end'])
+		return ret
+
+# counts of durations in power-of-two microsecond buckets
+class Histogram:
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = {} # upper bound in usec -> count
+
+	def add(self, secs):
+		self.count += 1
+		self.total += secs
+		self.max = max(self.max, secs)
+		bound = 1 << max(int(secs * 1e6), 0).bit_length()
+		self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+	def report(self):
+		hist = ','.join('%d:%d' % (b, self.buckets[b]) for b in sorted(self.buckets))
+		return ['count=%d' % self.count, 'avg_us=%d' % (self.total * 1e6 / self.count),
+			'max_us=%d' % (self.max * 1e6), 'hist=%s' % hist]
+
+# Owner.method for bound methods, just the name for plain functions
+def cb_name(fn):
+	owner = getattr(fn, '__self__', None)
+	if owner is not None:
+		return '%s.%s' % (owner.__class__.__name__, fn.__name__)
+	return fn.__name__
+
+# readiness backends. each one keeps track of which (fd, ev) pairs we're
+# interested in as Event.enable/disable are called, so that a loop iteration
+# doesn't need to rebuild the interest set from scratch.
+# register(fd, ev) / unregister(fd, ev) -- add or remove interest
+# and then either
+# poll(timeout) -- wait for readiness; returns a list of (fd, ev) pairs
+# or, for a backend that brings its own loop (see AsyncioPoller)
+# run() -- run events and timers until there are none left
+class SelectPoller:
+	name = 'select'
+
+	def __init__(self):
+		self.rset = set()
+		self.wset = set()
+
+	def register(self, fd, ev):
+		if ev == Event.READ:
+			self.rset.add(fd)
+		else:
+			self.wset.add(fd)
+
+	def unregister(self, fd, ev):
+		if ev == Event.READ:
+			self.rset.discard(fd)
+		else:
+			self.wset.discard(fd)
+
+	def poll(self, timeout):
+		(rlist, wlist, _) = select.select(self.rset, self.wset, [], timeout)
+		return [(fd, Event.READ) for fd in rlist] + [(fd, Event.WRITE) for fd in wlist]
+
+# linux only; cost per iteration is proportional to the number of ready fds,
+# and there's no FD_SETSIZE limit
+class EpollPoller:
+	name = 'epoll'
+
+	def __init__(self):
+		self.epoll = select.epoll()
+		self.masks = {} # fd -> currently registered epoll mask
+
+	@staticmethod
+	def ev2mask(ev):
+		if ev == Event.READ:
+			return select.EPOLLIN
+		else:
+			return select.EPOLLOUT
+
+	def register(self, fd, ev):
+		old = self.masks.get(fd, 0)
+		new = old | EpollPoller.ev2mask(ev)
+		if new == old:
+			return
+		if old:
+			self.epoll.modify(fd, new)
+		else:
+			self.epoll.register(fd, new)
+		self.masks[fd] = new
+
+	def unregister(self, fd, ev):
+		old = self.masks.get(fd, 0)
+		new = old & ~EpollPoller.ev2mask(ev)
+		if new == old:
+			return
+		try:
+			if new:
+				self.epoll.modify(fd, new)
+			else:
+				self.epoll.unregister(fd)
+		except (IOError, OSError), e:
+			# fd was already closed out from under us; the kernel dropped it
+			if e.errno not in (errno.EBADF, errno.ENOENT):
+				raise
+		if new:
+			self.masks[fd] = new
+		else:
+			del self.masks[fd]
+
+	def close(self):
+		self.epoll.close()
+
+	def poll(self, timeout):
+		if timeout is None:
+			timeout = -1
+		ret = []
+		for (fd, mask) in self.epoll.poll(timeout):
+			# errors and hangups wake up both directions, like select does
+			if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+				ret.append((fd, Event.READ))
+			if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+				ret.append((fd, Event.WRITE))
+		return ret
+
+# runs our events and timers on an asyncio loop (or trollius, on python 2)
+# instead of dispatch's own, so clients can share a process with other asyncio
+# code. fds are watched with add_reader/add_writer and the timer heap is
+# driven by a single call_later for the earliest timer. timers added from
+# outside of a mynet callback should be followed by a call to rearm()
+class AsyncioPoller:
+	name = 'asyncio'
+
+	def __init__(self, loop=None):
+		try:
+			import asyncio
+		except ImportError:
+			import trollius as asyncio
+		self.loop = loop or asyncio.get_event_loop()
+		self.handle = None # pending call_later for the next timer
+		self.when = None # time that handle fires at
+
+	def register(self, fd, ev):
+		if ev == Event.READ:
+			self.loop.add_reader(fd, self.callback, (fd, ev))
+		else:
+			self.loop.add_writer(fd, self.callback, (fd, ev))
+
+	def unregister(self, fd, ev):
+		if ev == Event.READ:
+			self.loop.remove_reader(fd)
+		else:
+			self.loop.remove_writer(fd)
+
+	def callback(self, key):
+		if key in Event.active:
+			Event.active[key].callback()
+		self.rearm()
+
+	def timer_cb(self):
+		self.handle = None
+		Event.run_timers()
+		self.rearm()
+
+	# point our timer handle at the earliest timer, and stop the loop if
+	# there's nothing left for us to do (same exit rule as dispatch)
+	def rearm(self):
+		if len(Event.active) == 0 and Event.ntimers == 0:
+			self.loop.stop()
+			return
+		timeout = Event.next_timeout()
+		when = timeout is not None and Event.timers[0][0] or None
+		if self.handle and self.when == when:
+			return
+		if self.handle:
+			self.handle.cancel()
+			self.handle = None
+		if timeout is not None:
+			self.handle = self.loop.call_later(timeout, self.timer_cb)
+			self.when = when
+
+	def run(self):
+		self.rearm()
+		self.loop.run_forever()
+
+# pick the best available backend, or a specific one by name.
+# with no name, the MYNET_POLLER environment variable is consulted, so the
+# backend can be chosen at startup without touching the client code
+def make_poller(name=None):
+	if name is None:
+		name = os.environ.get('MYNET_POLLER')
+	if name == 'epoll' or (name is None and hasattr(select, 'epoll')):
+		return EpollPoller()
+	elif name is None or name == 'select':
+		return SelectPoller()
+	elif name == 'asyncio':
+		return AsyncioPoller()
+	else:
+		raise ValueError('unknown poller: %s' % name)
+
 class Event:
 	active = {} # a dict from (fd, ev_type) to Event
-	timers = [] # list of Timer objects
+	timers = [] # heap of [timeout, seq, Timer] entries; cancelled entries have Timer = None
+	ntimers = 0 # number of live (not cancelled) entries in timers
+	timer_seq = itertools.count() # tie-breaker so equal timeouts fire in the order added
+	poller = None # readiness backend; created on first use
 	READ = 1
 	WRITE = 2
 
+	# switch readiness backends; must be called before any events are enabled
+	@staticmethod
+	def use_poller(name=None):
+		assert len(Event.active) == 0
+		Event.poller = make_poller(name)
+
+	# forget all events and timers, e.g. in a freshly forked child. the parent's
+	# epoll instance is shared across fork, so the child has to get its own.
+	# the asyncio loop can't be carried across a fork either, so fall back to
+	# the best native backend
+	@staticmethod
+	def reset():
+		old = Event.poller
+		Event.active = {}
+		Event.timers = []
+		Event.ntimers = 0
+		Event.poller = None
+		if old and hasattr(old, 'close'):
+			old.close()
+		if old and old.name != 'asyncio':
+			Event.poller = make_poller(old.name)
+		else:
+			Event.poller = make_poller(hasattr(select, 'epoll') and 'epoll' or 'select')
+
+	@staticmethod
+	def get_poller():
+		if not Event.poller:
+			Event.poller = make_poller()
+		return Event.poller
+
 	@staticmethod
 	def dispatch():
+		poller = Event.get_poller()
+		if hasattr(poller, 'run'):
+			# backend brings its own loop
+			poller.run()
+			return
+
 		while True:
 			# exit if we have no events to process
-			if len(Event.active) == 0 and len(Event.timers) == 0:
+			if len(Event.active) == 0 and Event.ntimers == 0:
 				break
 
-			rlist = []
-			wlist = []
+			if Stats.enabled:
+				start = time()
+				ready = poller.poll(Event.next_timeout())
+				Stats.record('poll.wait', time() - start)
+			else:
+				ready = poller.poll(Event.next_timeout())
 
-			for (fd, ev) in Event.active.iterkeys():
-				if ev == Event.READ:
-					rlist.append(fd)
-				elif ev == Event.WRITE:
-					wlist.append(fd)
+			# process timers first
+			Event.run_timers()
 
-			currtime = time()
+			for key in ready:
+				# an earlier callback may have disabled this one
+				if key in Event.active:
+					e = Event.active[key]
+					e.callback()
 
-			if len(Event.timers) == 0:
-				timeout = None
-			elif Event.timers[0].timeout > currtime:
-				timeout = Event.timers[0].timeout - currtime
-			else:
-				timeout = 0
+	# seconds until the next timer is due (None if there aren't any)
+	@staticmethod
+	def next_timeout():
+		# drop cancelled timers off the top so we don't wake up for them
+		while len(Event.timers) != 0 and Event.timers[0][2] is None:
+			heapq.heappop(Event.timers)
 
-			(rlist, wlist, _) = select(rlist, wlist, [], timeout)
+		if len(Event.timers) == 0:
+			return None
+		return max(Event.timers[0][0] - time(), 0)
 
-			# process timers first
-			while len(Event.timers) != 0 and Event.timers[0].timeout < time():
-				t = Event.timers[0]
-				Event.timers = Event.timers[1:]
-				t.callback() # call callback
-
-			for fd in rlist:
-				if (fd, Event.READ) in Event.active:
-					e = Event.active[(fd,Event.READ)]
-					e.callback()
-			for fd in wlist:
-				if (fd, Event.WRITE) in Event.active:
-					e = Event.active[(fd,Event.WRITE)]
-					e.callback()
+	# pull off everything that's expired as a batch and run it
+	@staticmethod
+	def run_timers():
+		currtime = time()
+		expired = []
+		while len(Event.timers) != 0 and Event.timers[0][0] < currtime:
+			entry = heapq.heappop(Event.timers)
+			if entry[2]:
+				expired.append(entry)
+		for entry in expired:
+			# an earlier callback in this batch may have removed it
+			t = entry[2]
+			if t:
+				t.entry = None # no longer queued; callback may re-add it
+				Event.ntimers -= 1
+				if Stats.enabled:
+					Stats.record('timer.lag', currtime - t.timeout)
+					Stats.call(t.callback)
+				else:
+					t.callback() # call callback
 
 	@staticmethod
-	def sort_timers():
-		Event.timers.sort(cmp = lambda a,b: cmp(a.timeout, b.timeout))
+	def compact_timers():
+		# rebuild the heap without cancelled entries, so lots of removed
+		# timers that were never going to fire don't pile up
+		Event.timers = [e for e in Event.timers if e[2]]
+		heapq.heapify(Event.timers)
 
 	def __init__(self, fd, ev, callback):
 		assert ev == Event.READ or ev == Event.WRITE
@@ -69,16 +387,41 @@ class Event:
 	def enable(self):
 		if (self.fd, self.ev) not in Event.active:
 			Event.active[(self.fd, self.ev)] = self
+			Event.get_poller().register(self.fd, self.ev)
 
 	def disable(self):
 		if (self.fd, self.ev) in Event.active:
 			del Event.active[(self.fd,self.ev)]
+			Event.get_poller().unregister(self.fd, self.ev)
 
 # a TCP socket. calls the following methods on the client object:
 # on_connect(sock) -- when socket is created
 # on_error(sock) -- when socket is disconnected
-# on_data(sock, data) -- when data arrives. return number of bytes consumed
+# on_data(sock, data) -- when data arrives. data is a memoryview of everything
+#   buffered but not yet consumed; return number of bytes consumed.
+#   sock.find_line() gives the offset of the first newline in data (or -1),
+#   or sock.next_msg(data) parses a whole message (see below)
+# and optionally, if the client has them:
+# on_pause(sock) -- more than high_water bytes are waiting to be sent; we've
+#   stopped reading from the socket until the peer catches up (unless
+#   sock.stop_reads is False)
+# on_resume(sock) -- back under low_water; reading again. a good time to
+#   produce more output, if there's more to send
 class StreamSocket:
+	RECV_SIZE = 4096 # minimum free space to offer each recv
+	RBUF_KEEP = 1 << 16 # an empty receive buffer bigger than this goes back to RECV_SIZE
+	SEND_SIZE = 65536 # max bytes to try per send when not using sendmsg
+	HIGH_WATER = 1 << 20 # default water marks for unsent data, in bytes
+	LOW_WATER = 1 << 18
+
+	# messages are lists of words. one word may be a value (arbitrary bytes);
+	# sock.values maps a message's first word to the index of its value.
+	# in text mode a message is the words joined by spaces plus a newline, with
+	# the value base64-encoded. in binary mode (after a BINARY line is sent or
+	# received) it's a frame: this header, then the other words joined by
+	# spaces, then the raw value
+	FRAME = struct.Struct('!IIB') # header length, value length, value index
+	NO_VALUE = 255
 	def __init__(self, sock, client):
 		self.client = client
 		self.socket = sock
@@ -89,12 +432,34 @@ class StreamSocket:
 		self.rev = Event(self.socket.fileno(), Event.READ, self.read_cb)
 		self.rev.enable()
 
-		# set up buffers
-		self.rbuf = ""
-		self.wbuf = ""
+		# set up buffers. rbuf[rstart:rend] is unconsumed data; rscan is how far
+		# we've already looked for a newline, so partial lines aren't rescanned
+		self.rbuf = bytearray(StreamSocket.RECV_SIZE)
+		self.rstart = 0
+		self.rend = 0
+		self.rscan = 0
+		# pending writes: a queue of strings, the offset of the first unsent
+		# byte of wbuf[0], and the total number of unsent bytes
+		self.wbuf = deque()
+		self.woff = 0
+		self.wlen = 0
 
 		self.name = ""
 		self.send_eof = False
+		self.binary = False # framing mode; see FRAME
+		self.values = {} # first word -> index of value word; see FRAME
+		self.connecting = False # connect() in progress; can't send yet
+		self.closed = False
+
+		# flow control; see set_water
+		self.high_water = StreamSocket.HIGH_WATER
+		self.low_water = StreamSocket.LOW_WATER
+		self.paused = False
+		self.stop_reads = True # whether being paused stops reading
+		self.held = False # reading stopped by hold()
+
+		if Stats.enabled:
+			Stats.streams.add(self)
 
 		self.client.on_connect(self) # call callback
 
@@ -102,63 +467,266 @@ class StreamSocket:
 		return '%x' % id(self)
 
 	def connect(self, host, port):
+		self.connecting = True
 		self.socket.connect_ex((host, int(port)))
 
+	# make sure there's room for at least RECV_SIZE more bytes after rend
+	def reserve_rbuf(self):
+		if len(self.rbuf) - self.rend >= StreamSocket.RECV_SIZE:
+			return
+		used = self.rend - self.rstart
+		if self.rstart > 0 and used + StreamSocket.RECV_SIZE <= len(self.rbuf) / 2:
+			# mostly consumed; slide the remainder down to the front
+			self.rbuf[0:used] = self.rbuf[self.rstart:self.rend]
+			self.rscan = max(self.rscan - self.rstart, 0)
+			self.rstart = 0
+			self.rend = used
+		else:
+			# double, so growing to fit a big message is linear overall
+			self.rbuf.extend(bytearray(max(len(self.rbuf), StreamSocket.RECV_SIZE)))
+
 	def read_cb(self):
 		# ok, socket is ready for reading
-		ret = self.socket.recv(4096)
-		if len(ret) == 0: # disconnected
+		self.reserve_rbuf()
+		try:
+			ret = self.socket.recv_into(memoryview(self.rbuf)[self.rend:])
+		except socket.error, e:
+			if e.errno in SEND_AGAIN:
+				return
+			ret = 0 # refused, reset, etc.; same as a disconnect as far as we're concerned
+		if ret == 0: # disconnected
 			self.client.on_error(self)
 			self.close()
 			return
 
-		self.rbuf += ret
+		self.rend += ret
 
 		def helper(self):
-			ret = self.client.on_data(self, self.rbuf)
-			self.rbuf = self.rbuf[ret:]
+			view = memoryview(self.rbuf)[self.rstart:self.rend]
+			if Stats.enabled:
+				ret = Stats.call(self.client.on_data, self, view)
+			else:
+				ret = self.client.on_data(self, view)
+			del view # rbuf can't be resized while a view is alive
+			self.rstart += ret
+			if self.rstart == self.rend:
+				# everything consumed; start over at the front of the buffer.
+				# if a big message grew it, let that go, or a long-lived
+				# connection would hang on to its biggest message's worth
+				self.rstart = self.rend = self.rscan = 0
+				if len(self.rbuf) > StreamSocket.RBUF_KEEP:
+					self.rbuf = bytearray(StreamSocket.RECV_SIZE)
 			return ret
 
 		while helper(self) > 0:
 			pass
 
+	# offset of the first newline in the unconsumed data, or -1 if there isn't
+	# a complete line yet. only looks at bytes it hasn't looked at before
+	def find_line(self):
+		pos = self.rbuf.find('\n', max(self.rscan, self.rstart), self.rend)
+		if pos < 0:
+			self.rscan = self.rend
+			return -1
+		return pos - self.rstart
+
+	# parse the next message out of data. returns (bytes consumed, words);
+	# words is None if there's no complete message yet (consumed = 0), or for
+	# a keep-alive or a BINARY upgrade, which are handled here
+	def next_msg(self, data):
+		if self.binary:
+			size = StreamSocket.FRAME.size
+			if len(data) < size:
+				return (0, None)
+			(hlen, vlen, vpos) = StreamSocket.FRAME.unpack(data[0:size].tobytes())
+			if len(data) < size + hlen + vlen:
+				return (0, None)
+			args = data[size:size+hlen].tobytes().split(' ')
+			if vpos != StreamSocket.NO_VALUE:
+				args.insert(vpos, data[size+hlen:size+hlen+vlen].tobytes())
+			return (size + hlen + vlen, args)
+
+		pos = self.find_line()
+		if pos < 0: # need to wait for new line
+			return (0, None)
+		elif pos == 0:
+			return (1, None) # just a keep-alive
+
+		args = data[0:pos].tobytes().split(' ')
+		if args == ['BINARY']:
+			# other end is switching to frames; so do we
+			self.binary = True
+			return (pos + 1, None)
+		vpos = self.values.get(args[0])
+		if vpos is not None and vpos < len(args):
+			args[vpos] = base64.b64decode(args[vpos])
+		return (pos + 1, args)
+
+	# switch this connection to binary frames (see FRAME); the other end has
+	# to be using next_msg to understand it
+	def upgrade(self):
+		self.write(['BINARY'])
+		self.binary = True
+
+	# drop n sent bytes off the front of the write queue
+	def consume_wbuf(self, n):
+		self.wlen -= n
+		while n > 0:
+			left = len(self.wbuf[0]) - self.woff
+			if n < left:
+				self.woff += n
+				return
+			n -= left
+			self.wbuf.popleft()
+			self.woff = 0
+
+	# send as much queued data as the socket will take without blocking.
+	# returns True if the queue was emptied
+	def flush(self):
+		while self.wlen > 0:
+			try:
+				if HAVE_SENDMSG:
+					bufs = [memoryview(self.wbuf[0])[self.woff:]]
+					for i in xrange(1, min(len(self.wbuf), IOV_MAX)):
+						bufs.append(self.wbuf[i])
+					want = sum(len(b) for b in bufs)
+					ret = self.socket.sendmsg(bufs)
+				else:
+					want = min(len(self.wbuf[0]) - self.woff, StreamSocket.SEND_SIZE)
+					ret = self.socket.send(memoryview(self.wbuf[0])[self.woff:self.woff+want])
+			except socket.error, e:
+				if e.errno in SEND_AGAIN:
+					return False
+				raise
+			self.consume_wbuf(ret)
+			if ret < want: # short write; socket buffer is full
+				return False
+		return True
+
 	def write_cb(self):
 		# socket ready for writing
-		ret = self.socket.send(self.wbuf)
-		self.wbuf = self.wbuf[ret:] # remove sent data
-		if len(self.wbuf) == 0 and self.send_eof:
+		self.connecting = False
+		try:
+			done = self.flush()
+		except socket.error:
+			# connection refused or reset
+			self.client.on_error(self)
 			self.close()
-		elif len(self.wbuf) == 0:
+			return
+		if done and self.send_eof:
+			self.close()
+			return
+		elif self.wlen == 0:
 			self.wev.disable()
+		self.check_water()
+
+	def set_water(self, high, low):
+		assert low <= high
+		self.high_water = high
+		self.low_water = low
+		self.check_water()
+
+	# pause or resume reading depending on how much is waiting to go out
+	def check_water(self):
+		if not self.paused and self.wlen > self.high_water:
+			self.paused = True
+			if self.stop_reads:
+				self.rev.disable()
+			if hasattr(self.client, 'on_pause'):
+				self.client.on_pause(self)
+		elif self.paused and self.wlen <= self.low_water:
+			self.paused = False
+			if not self.send_eof and not self.held:
+				self.rev.enable()
+			if hasattr(self.client, 'on_resume'):
+				self.client.on_resume(self)
+
+	# stop reading until release(), whatever the water marks say; for when
+	# what we read goes out on some other socket that has backed up
+	def hold(self):
+		self.held = True
+		self.rev.disable()
 
-	def write(self, data): # data is a list; things are joined by spaces
-		self.write_raw(' '.join(data) + '\n')
+	def release(self):
+		self.held = False
+		if not (self.paused and self.stop_reads) and not self.send_eof and not self.closed:
+			self.rev.enable()
+
+	# data is a list; things are joined by spaces. vpos is the index of
+	# the value in data, if it's not the one given by self.values. the value
+	# can be a list of pieces, which go out one after another as one value
+	# without being joined first
+	def write(self, data, vpos=None):
+		if vpos is None and len(data) != 0:
+			vpos = self.values.get(data[0])
+		if vpos is not None and vpos >= len(data):
+			vpos = None
+		if self.binary:
+			if vpos is None:
+				header = ' '.join(data)
+				pieces = []
+			else:
+				header = ' '.join(data[:vpos] + data[vpos+1:])
+				pieces = data[vpos]
+				if not isinstance(pieces, list):
+					pieces = [pieces]
+			self.write_raw(StreamSocket.FRAME.pack(len(header), sum(len(i) for i in pieces),
+				vpos is None and StreamSocket.NO_VALUE or vpos) + header)
+			for i in pieces:
+				self.write_raw(i)
+		elif vpos is not None:
+			data = list(data)
+			value = data[vpos]
+			if isinstance(value, list):
+				value = ''.join(str(i) for i in value)
+			data[vpos] = base64.b64encode(value)
+			self.write_raw(' '.join(data) + '\n')
+		else:
+			self.write_raw(' '.join(data) + '\n')
 
 	def write_raw(self, data):
-		self.wbuf += data
+		if len(data) == 0:
+			return
+		was_empty = self.wlen == 0
+		self.wbuf.append(data)
+		self.wlen += len(data)
 		if DEBUG: print 'out %s: %s' % (self, data)
+		# if nothing else is queued, the socket is probably writable right now;
+		# try sending immediately rather than waiting a loop iteration
+		if was_empty and not self.connecting:
+			try:
+				if self.flush():
+					return
+			except socket.error:
+				pass # let write_cb run into it again and deal with it
 		self.wev.enable()
+		self.check_water()
 
 	def close_when_done(self):
-		if len(self.wbuf) == 0:
+		if self.wlen == 0:
 			self.close()
 		else:
 			self.send_eof = True
 			self.rev.disable()
 
 	def close(self):
+		self.closed = True
 		self.wev.disable()
 		self.rev.disable()
 		self.socket.close()
 
 # a listening TCP socket. doesn't do any callbacks, but
-# the StreamSocket it creates does
+# the StreamSocket it creates does. with reuseport, several processes can
+# each have their own ListenSocket on the same port and the kernel spreads
+# incoming connections across them
 class ListenSocket:
-	def __init__(self, bindport, client):
+	def __init__(self, bindport, client, reuseport=False):
 		self.client = client
 		self.socket = socket.socket()
 		self.socket.setblocking(0)
 		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if reuseport:
+			self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 		self.socket.bind(('', bindport))
 		self.socket.listen(5)
 
@@ -176,6 +744,9 @@ class ListenSocket:
 # a UDP socket. callback is:
 # on_dgram(socket, data)
 class DgramSocket:
+	READ_BUDGET = 64 # max datagrams to read per readiness event, so we don't starve others
+	SENDQ_MAX = 4096 # drop outgoing datagrams past this many queued
+
 	def __init__(self, bindport, client):
 		self.client = client
 
@@ -192,17 +763,57 @@ class DgramSocket:
 
 		self.wev = Event(self.socket.fileno(), Event.WRITE, self.write_cb)
 
-		self.sendq = [] # list of (data, addr) tuples
+		self.sendq = deque() # queue of (data, addr) tuples
+
+		# counters
+		self.pkts_in = 0
+		self.bytes_in = 0
+		self.pkts_out = 0
+		self.bytes_out = 0
+		self.drops = 0 # datagrams we gave up sending (queue full or send error)
+		self.rerrors = 0 # errors on receive (e.g. ICMP unreachable reported back)
+
+		if Stats.enabled:
+			Stats.dgrams.add(self)
 
 	def read_cb(self):
-		data = self.socket.recv(4096)
-		self.client.on_dgram(self, data)
+		# drain whatever's waiting, up to the budget
+		for i in xrange(DgramSocket.READ_BUDGET):
+			try:
+				data = self.socket.recv(4096)
+			except socket.error, e:
+				if e.errno not in SEND_AGAIN:
+					self.rerrors += 1
+				return
+			self.pkts_in += 1
+			self.bytes_in += len(data)
+			if Stats.enabled:
+				Stats.call(self.client.on_dgram, self, data)
+			else:
+				self.client.on_dgram(self, data)
+			if (self.rev.fd, Event.READ) not in Event.active:
+				return # callback closed us
+
+	# send everything queued until the socket would block.
+	# returns True if the queue was emptied
+	def flush(self):
+		while len(self.sendq) != 0:
+			(data, addr) = self.sendq[0]
+			try:
+				self.socket.sendto(data, 0, addr)
+			except socket.error, e:
+				if e.errno in SEND_AGAIN:
+					return False
+				# unreachable, bad address, etc.; nothing retrying will fix
+				self.drops += 1
+			else:
+				self.pkts_out += 1
+				self.bytes_out += len(data)
+			self.sendq.popleft()
+		return True
 
 	def write_cb(self):
-		(data, addr) = self.sendq[0]
-		self.sendq = self.sendq[1:]
-		self.socket.sendto(data, 0, addr)
-		if len(self.sendq) == 0:
+		if self.flush():
 			self.wev.disable()
 
 	def send(self, addr, data):
@@ -213,8 +824,15 @@ class DgramSocket:
 		self.send_raw((host, int(port)), ' '.join(data))
 
 	def send_raw(self, addr, data):
-		self.sendq += [(data, addr)]
+		if len(self.sendq) >= DgramSocket.SENDQ_MAX:
+			self.drops += 1
+			return
+		was_empty = len(self.sendq) == 0
+		self.sendq.append((data, addr))
 		if DEBUG: print 'out %s: %s' % (addr, data)
+		# like StreamSocket.write_raw, try to get it out without a loop iteration
+		if was_empty and self.flush():
+			return
 		self.wev.enable()
 
 	def close(self):
@@ -227,18 +845,25 @@ class Timer:
 	def __init__(self, t, callback):
 		self.timeout = t + time()
 		self.callback = callback
+		self.entry = None # our heap entry, if we're queued
 
 	def add(self):
 		# if already added, do nothing
-		if Event.timers.count(self) == 0:
-			Event.timers.append(self)
-		Event.sort_timers()
+		if self.entry:
+			return
+		self.entry = [self.timeout, Event.timer_seq.next(), self]
+		heapq.heappush(Event.timers, self.entry)
+		Event.ntimers += 1
 
 	def remove(self):
-		# remove all instances (shouldn't be more than one, but...)
-		while Event.timers.count(self) > 0:
-			Event.timers.remove(self)
-		Event.sort_timers()
+		# lazy deletion: just mark our entry as dead, dispatch will skip it
+		if not self.entry:
+			return
+		self.entry[2] = None
+		self.entry = None
+		Event.ntimers -= 1
+		if len(Event.timers) > 64 and Event.ntimers < len(Event.timers) / 2:
+			Event.compact_timers()
 
 	def __str__(self):
 		return '%d:%s' % (self.timeout, self.callback)
@@ -1,20 +1,87 @@
 #!/usr/bin/env python
 import base64
+import bisect
 import hashlib
+import heapq
+import os
 import random
 import socket
 import sys
-from mynet import Event, StreamSocket, DgramSocket, Timer, ListenSocket
+import tempfile
+import time
+from collections import OrderedDict
+from mynet import Event, StreamSocket, DgramSocket, Timer, ListenSocket, Stats
 from manage import Manager
+from store import open_store, pack, unpack, RAW
+
+# which word of each TCP message is a value: base64-encoded in text mode,
+# raw bytes on connections upgraded to binary frames (see StreamSocket.FRAME).
+# handlers always see the raw bytes
+VALUE_ARG = {'CPUT': 1, 'CDATA': 1, 'PUT': 1, 'DATA': 1, 'XFER': 2,
+	'CCHUNK': 3, 'CPART': 2, 'PCHUNK': 2, 'PART': 3,
+	'CMDATA': 2, 'MPUT': 1, 'MDATA': 1}
+
+# largest piece of a value sent in one message by chunked transfers
+CHUNK_SIZE = 65536
+
+# each item is kept by its owner and the owner's next REPLICAS-1 successors
+REPLICAS = int(os.environ.get('PLMAN_REPLICAS', 3))
+# how long a GET waits for one replica before asking the next one as well,
+# at least; slower replicas get twice their smoothed round trip time
+HEDGE_DELAY = 0.05
+# how long a request routed by the OwnerCache gets before we do a real lookup
+CACHE_TIMEOUT = 2
+
+# how we find owners: "recursive" passes a FIND along the ring; "iterative"
+# has us ask each hop ourselves (see Lookup), which copes with lost packets
+LOOKUP_MODE = os.environ.get('PLMAN_LOOKUP', 'recursive')
+
+# with PLMAN_COMPRESS=1, values are compressed when stored if that makes them
+# enough smaller (see store.pack), and passed between peers that way
+COMPRESS = os.environ.get('PLMAN_COMPRESS') == '1'
+
+# failure detection. anything we hear from a peer shows it's alive, so we
+# only PING peers that have been quiet for a probe interval. once a peer has
+# missed PROBES pings in a row (the last one given its Rtt timeout to come
+# back), it's dead. pings are followed up after PROBE_MIN. the interval drops
+# to PROBE_MIN whenever our neighbours change and creeps back up to PROBE_MAX
+# while they don't; stabilization runs on the same interval
+PROBE_MIN = 2
+PROBE_MAX = 10
+PROBES = 3
+
+# index of the value in a RELAY message wrapping args
+def relay_vpos(args):
+	if args[0] in VALUE_ARG:
+		return VALUE_ARG[args[0]] + 2
+	return None
 
 class Trans:
 	# transaction types (i.e., reasons for making DHT requests)
 	FINGER = 0 # finding finger peers for us (index = finger table index)
 	BACKUP = 1 # finding redundant successors in case real one dies
 	PRUNE = 2 # are we still in charge of this file? if not, drop it
-	GET = 10 # finding place for client to get data (client = client socket)
+	GET = 10 # finding place for client to get data (client = client socket, asked = {socket: replica} for GETs sent)
 	PUT = 11 # finding place for client to put data (client = client socket, data = file data))
-	SHOW = 12 # transaction is asking for peer list (client = client socket, timer = 30sec timer)
+	SHOW = 12 # transaction is asking for peer list (client = client socket)
+	LOOKUP = 13 # finding owner for a worker process (client = worker channel, index = worker's request id)
+	UPLOAD = 14 # finding place for a chunked upload (client = client socket, upload = Upload)
+	FETCH = 15 # finding place for client to read part of a value (client = client socket, range = (offset, length))
+	MGET = 16 # finding places for a CMGET (client = client socket, values = {hash: None})
+	MPUT = 17 # finding places for a CMPUT (client = client socket, values = {hash: (codec, value)})
+
+	NAMES = {FINGER: 'finger', BACKUP: 'backup', PRUNE: 'prune', GET: 'get', PUT: 'put',
+		SHOW: 'show', LOOKUP: 'lookup', UPLOAD: 'upload', FETCH: 'fetch', MGET: 'mget', MPUT: 'mput'}
+	CLIENT_TYPES = (GET, PUT, SHOW, LOOKUP, UPLOAD, FETCH, MGET, MPUT)
+
+	# seconds each type gets before it's given up on (see TransTable). a SHOW
+	# always runs out its time, since we can't tell when the last PEER is in;
+	# streaming transfers get their time again each time they make progress
+	DEADLINES = {FINGER: 30, BACKUP: 30, PRUNE: 30, GET: 30, PUT: 30,
+		SHOW: 10, LOOKUP: 30, UPLOAD: 60, FETCH: 60, MGET: 60, MPUT: 60}
+	# a batch's lookups get this long; then it goes ahead with the owners it
+	# has, and gets its full deadline for the owners to answer
+	BATCH_LOOKUP = 10
 
 	next = 0 # incrementing count of transactions
 
@@ -27,55 +94,682 @@ class Trans:
 			Trans.next += 1
 			return '%s-%d' % (main.myname, num)
 		self.id = make_trans()
+		self.deadline = None # set by TransTable
+		self.expired = False
 
 		if self.type == Trans.FINGER:
 			self.index = arg1
+			self.end = arg2 # building the table: keep going until we've filled this slot
 		elif self.type == Trans.BACKUP:
 			pass # nothing special to do
 		elif self.type == Trans.PRUNE:
 			pass # nothing special to do
 		elif self.type == Trans.GET:
 			self.client = arg1
+			self.codecs = arg2 # codecs the client can take values in
+			self.hash = None
+			self.cached = False # owner came from the OwnerCache
+			self.retry = None # timer to give up on the cache
+			self.replicas = [] # replicas not asked yet
+			self.asked = {}
+			self.hedge = None # timer to ask the next replica
 		elif self.type == Trans.PUT:
 			self.client = arg1
-			self.data = arg2
+			self.data = arg2 # (codec, data); see store.pack
+			self.sock = None # connection the request went out on
+			self.hash = None
+			self.cached = False
+			self.retry = None
+		elif self.type == Trans.LOOKUP:
+			self.client = arg1
+			self.index = arg2
+		elif self.type == Trans.UPLOAD:
+			self.client = arg1
+			self.upload = arg2
+			self.sock = None
+		elif self.type == Trans.FETCH:
+			self.client = arg1
+			self.range = arg2
+			self.sock = None
+		elif self.type == Trans.MGET or self.type == Trans.MPUT:
+			self.client = arg1
+			self.values = arg2
+			self.waiting = set(arg2) # hashes still being looked up
+			self.owners = {} # owner -> hashes it has that we haven't asked it for yet
+			self.flush = None # timer to ask them; see queue_batch
+			self.sent = {} # socket -> [hashes of each request on it that it hasn't answered], oldest first
 		elif self.type == Trans.SHOW:
 			self.client = arg1
-			# create a timer; allow 30 seconds for a show to complete
-			def cb():
-				self.remove()
-				# close client connection; we won't receive any more peer responses
-				self.client.close_when_done()
-			# we use a timeout to determine the roll call being done because
-			# getting the SHOW message back doesn't mean we've seen all PEER messages
-			self.timer = Timer(10, cb)
-			self.timer.add()
+
+	def is_client(self):
+		return self.type in Trans.CLIENT_TYPES
 
 	def add(self):
-		self.main.trans[self.id] = self
+		self.main.trans.add(self)
+
+	# still making progress; put off the deadline (to secs from now, if given)
+	def touch(self, secs=None):
+		self.main.trans.touch(self, secs)
 
 	def remove(self):
-		if self.type == Trans.SHOW:
+		if self.type in (Trans.MGET, Trans.MPUT) and self.flush:
+			self.flush.remove()
+		elif self.type == Trans.GET and self.hedge:
+			self.hedge.remove()
+		if (self.type == Trans.GET or self.type == Trans.PUT) and self.retry:
+			self.retry.remove()
+		elif self.type == Trans.UPLOAD:
+			if self.sock:
+				# stop streaming from the spool before it goes
+				self.main.pumps.pop(self.sock, None)
+				self.sock.close()
+			self.upload.close()
+		elif self.type == Trans.FETCH:
+			self.main.holds.pop(self.client, None)
+			self.main.pumps.pop(self.client, None)
+			if self.sock:
+				# the owner may still be held, with PARTs backed up behind it
+				self.main.holds.pop(self.sock, None)
+				self.main.pumps.pop(self.sock, None)
+				self.main.sockets.discard(self.sock)
+				self.sock.close()
+		self.main.trans.remove(self)
+
+# transactions in progress, by id. each gets a deadline from Trans.DEADLINES
+# when it's added; they're all kept in one heap that a single timer sweeps,
+# so a lost FIND or FOUND can't leave a transaction (and the client and data
+# it holds) behind forever. client transactions are limited to MAX_CLIENT at
+# a time, so a flood of them can't either
+class TransTable(dict):
+	SWEEP = 1 # seconds between looking for expired transactions
+	MAX_CLIENT = int(os.environ.get('PLMAN_MAX_CLIENT', 1024))
+
+	def __init__(self, main):
+		dict.__init__(self)
+		self.main = main
+		self.deadlines = [] # heap of (deadline, id); stale entries are skipped
+		self.clients = 0 # client transactions in the table
+		self.completed = {} # type -> count
+		self.expired = {}
+		self.rejected = 0 # client requests turned away because we were full
+		self.schedule()
+
+	def schedule(self):
+		self.timer = Timer(TransTable.SWEEP, self.sweep)
+		self.timer.add()
+
+	# is there room for another client transaction? if not, count the one
+	# being turned away
+	def admit(self):
+		if self.clients < TransTable.MAX_CLIENT:
+			return True
+		self.rejected += 1
+		return False
+
+	def add(self, t):
+		self[t.id] = t
+		if t.is_client():
+			self.clients += 1
+		self.touch(t)
+
+	def touch(self, t, secs=None):
+		t.deadline = time.time() + (secs or Trans.DEADLINES[t.type])
+		heapq.heappush(self.deadlines, (t.deadline, t.id))
+
+	def remove(self, t):
+		del self[t.id]
+		if t.is_client():
+			self.clients -= 1
+		if t.expired:
+			self.expired[t.type] = self.expired.get(t.type, 0) + 1
+		else:
+			self.completed[t.type] = self.completed.get(t.type, 0) + 1
+
+	def sweep(self):
+		self.schedule()
+		now = time.time()
+		while self.deadlines and self.deadlines[0][0] <= now:
+			(deadline, id) = heapq.heappop(self.deadlines)
+			t = self.get(id)
+			if t and t.deadline == deadline: # otherwise it's gone, or was touched since
+				self.main.expire(t)
+		# touches leave stale entries behind; don't let them pile up
+		if len(self.deadlines) > 2 * len(self) + 64:
+			self.deadlines = [(tr.deadline, tid) for (tid, tr) in self.iteritems()]
+			heapq.heapify(self.deadlines)
+
+	# STAT lines for the STATS command
+	def report(self):
+		ret = [['STAT', 'trans', 'active=%d' % len(self), 'clients=%d' % self.clients,
+			'rejected=%d' % self.rejected]]
+		for (type, name) in sorted(Trans.NAMES.items()):
+			if type in self.completed or type in self.expired:
+				ret.append(['STAT', 'trans.%s' % name, 'completed=%d' % self.completed.get(type, 0),
+					'expired=%d' % self.expired.get(type, 0)])
+		return ret
+
+	def close(self):
+		self.timer.remove()
+
+# owners of parts of the ring we've looked up recently, so repeat requests
+# can go straight there. FOUND saying peer owns key means nobody is between
+# key and peer, so peer owns everything from key up to itself; for each owner
+# we keep the widest such range we've seen. entries expire after TTL, and the
+# least recently used go when there are more than SIZE
+class OwnerCache:
+	TTL = 30
+	SIZE = 1024
+
+	def __init__(self):
+		self.entries = OrderedDict() # owner id -> [peer, start of range, replicas, expiry time], least recently used first
+		self.ids = [] # owner ids, sorted
+
+	# how far key is behind id, going round the ring
+	@staticmethod
+	def behind(key, id):
+		return (id - key) % RING_SIZE
+
+	# FOUND: peer owns key, and replicas have copies
+	def add(self, key, peer, replicas):
+		oid = node_id(peer)
+		e = self.entries.pop(oid, None)
+		start = key
+		if e is None:
+			bisect.insort(self.ids, oid)
+		elif e[3] > time.time() and OwnerCache.behind(key, oid) < OwnerCache.behind(e[1], oid):
+			start = e[1] # already had a wider range
+		self.entries[oid] = [peer, start, replicas, time.time() + OwnerCache.TTL]
+		if len(self.entries) > OwnerCache.SIZE:
+			self.remove(next(iter(self.entries)))
+
+	# id of the entry that would cover key
+	def find(self, key):
+		if not self.ids:
+			return None
+		i = bisect.bisect_left(self.ids, key)
+		return self.ids[i % len(self.ids)] # wraps around past the top
+
+	# (owner, replicas) for key, or None if we don't know
+	def lookup(self, key):
+		oid = self.find(key)
+		if oid is None:
+			return None
+		e = self.entries[oid]
+		if e[3] < time.time():
+			self.remove(oid)
+			return None
+		if OwnerCache.behind(key, oid) > OwnerCache.behind(e[1], oid):
+			return None
+		# move to the most recently used end
+		del self.entries[oid]
+		self.entries[oid] = e
+		return (e[0], e[2])
+
+	# what we had for key turned out to be wrong
+	def invalidate(self, key):
+		oid = self.find(key)
+		if oid is not None:
+			self.remove(oid)
+
+	# peer is dead
+	def forget(self, peer):
+		if node_id(peer) in self.entries:
+			self.remove(node_id(peer))
+
+	def remove(self, oid):
+		del self.entries[oid]
+		del self.ids[bisect.bisect_left(self.ids, oid)]
+
+# values clients have read through us lately, so popular ones can be served
+# without bothering their owners. a value never changes under its hash (the
+# hash is of the value), so a copy is as good as the owner's, as long as it
+# really does hash to its key; add() checks. values are kept as they came
+# (see store.pack), and the total size is bounded, least recently used
+# going first
+class ValueCache:
+	SIZE = int(os.environ.get('PLMAN_VALUE_CACHE', 16 << 20)) # bytes; 0 turns it off
+	MAX_ITEM = SIZE / 16 # bigger values aren't kept
+
+	def __init__(self):
+		self.entries = OrderedDict() # hash -> (codec, data), least recently used first
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+
+	# (codec, data) for hash, or None
+	def get(self, hash):
+		e = self.entries.pop(hash, None)
+		if e is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries[hash] = e # now the most recently used
+		return e
+
+	def add(self, hash, codec, data):
+		if len(data) > ValueCache.MAX_ITEM or hash in self.entries:
+			return
+		if make_file_id(unpack(codec, data)) != hash:
+			return
+		self.entries[hash] = (codec, str(data))
+		self.size += len(data)
+		while self.size > ValueCache.SIZE:
+			(old, e) = self.entries.popitem(last=False)
+			self.size -= len(e[1])
+
+	# (entries, bytes, hits, misses)
+	def counts(self):
+		return (len(self.entries), self.size, self.hits, self.misses)
+
+	# STAT line for a cache with these counts; name tells the coordinator's
+	# cache from the workers' (see Worker.sweep)
+	@staticmethod
+	def report(name, counts):
+		(entries, size, hits, misses) = counts
+		rate = 0.0
+		if hits + misses:
+			rate = float(hits) / (hits + misses)
+		return ['STAT', name, 'entries=%d' % entries, 'bytes=%d' % size,
+			'hits=%d' % hits, 'misses=%d' % misses, 'hit_rate=%.3f' % rate]
+
+# long-lived connections to other peers, one each, shared by all the
+# requests we send them; replies carry transaction ids, so they can be matched
+# up however they interleave. POOL tells the other end not to hang up after
+# replying. connections unused for IDLE seconds are closed, and the owner
+# drops a peer's connection when it finds the peer dead
+class ConnPool:
+	IDLE = 60
+	CHECK = 15 # how often to look for idle connections
+	# keepalive probes: start after KEEPIDLE quiet seconds, every KEEPINTVL,
+	# and give up after KEEPCNT unanswered, well within IDLE (the kernel's
+	# defaults wait two hours before the first one)
+	KEEPIDLE = 10
+	KEEPINTVL = 5
+	KEEPCNT = 3
+
+	def __init__(self, owner):
+		self.owner = owner # Main or Worker; connections are made with its connect
+		self.conns = {} # peer -> socket
+		self.peers = {} # socket -> peer
+		self.used = {} # peer -> when its connection was last handed out or heard from
+		self.timer = None
+		self.schedule()
+
+	def schedule(self):
+		self.timer = Timer(ConnPool.CHECK, self.check)
+		self.timer.add()
+
+	def get(self, peer):
+		s = self.conns.get(peer)
+		if not s or s.closed:
+			s = self.owner.connect(peer)
+			# let the kernel notice if the peer's host vanishes while we're idle
+			s.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+			if hasattr(socket, 'TCP_KEEPIDLE'): # not everywhere (e.g. OS X)
+				s.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, ConnPool.KEEPIDLE)
+				s.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, ConnPool.KEEPINTVL)
+				s.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, ConnPool.KEEPCNT)
+			no_delay(s)
+			s.write(['POOL'])
+			self.conns[peer] = s
+			self.peers[s] = peer
+		self.used[peer] = time.time()
+		return s
+
+	# traffic came in on s; it's still in use
+	def touch(self, s):
+		peer = self.peers.get(s)
+		if peer and self.conns.get(peer) == s:
+			self.used[peer] = time.time()
+
+	# connection went away; called from the owner's on_error
+	def discard(self, s):
+		peer = self.peers.pop(s, None)
+		if peer and self.conns.get(peer) == s:
+			del self.conns[peer]
+			del self.used[peer]
+
+	# close our connection to peer. the owner's on_error sees it first, so
+	# requests waiting on it can fail over
+	def drop(self, peer):
+		s = self.conns.get(peer)
+		if s:
+			self.owner.on_error(s)
+			s.close()
+
+	def check(self):
+		self.schedule()
+		now = time.time()
+		for (peer, when) in self.used.items():
+			# one that's still sending isn't idle, however long it's been
+			if now - when > ConnPool.IDLE and not self.conns[peer].wlen:
+				self.drop(peer)
+
+	def close(self):
+		self.timer.remove()
+		for s in self.peers.keys():
+			s.close()
+		self.conns = {}
+		self.peers = {}
+		self.used = {}
+
+# a chunked upload, at the node the client is talking to. pieces are spooled
+# to a temporary file as they come in, rather than kept in memory, and hashed
+# along the way; on commit we know the hash, so the owner can be found and
+# the spool streamed to it. if the client's connection drops, it can pick up
+# with CRESUME after the last chunk we acknowledged
+class Upload:
+	TIMEOUT = 300 # forget uploads that haven't been touched in this long
+
+	def __init__(self, main):
+		self.main = main
+		self.id = '%s-u%x' % (main.myname, random.getrandbits(48))
+		self.spool = tempfile.TemporaryFile()
+		self.hash = hashlib.sha1('\x01') # as in make_file_id
+		self.size = 0
+		self.seq = -1 # last chunk acknowledged
+		self.timer = None
+		self.touch()
+
+	def touch(self):
+		if self.timer:
+			self.timer.remove()
+		self.timer = Timer(Upload.TIMEOUT, self.expire)
+		self.timer.add()
+
+	def expire(self):
+		print 'upload %s abandoned' % self.id
+		self.timer = None
+		del self.main.uploads[self.id]
+		self.close()
+
+	def add(self, data):
+		self.spool.write(data)
+		self.hash.update(data)
+		self.size += len(data)
+		self.seq += 1
+		self.touch()
+
+	# the value, a piece at a time
+	def pieces(self):
+		self.spool.seek(0)
+		while True:
+			data = self.spool.read(CHUNK_SIZE)
+			if not data:
+				break
+			yield data
+
+	def close(self):
+		if self.timer:
 			self.timer.remove()
-		del self.main.trans[self.id]
+			self.timer = None
+		self.spool.close()
+
+# finger table. behaves like a list of 160 peers (or None), where finger[i]
+# is the first peer at least 2^i past us; finger[0] is our successor. since
+# most slots hold the same few peers, we also keep the distinct peers sorted
+# by their distance from us, for routing and pinging
+class FingerTable:
+	def __init__(self, my_id, size=160):
+		self.my_id = my_id
+		self.size = size
+		self.slots = {} # index -> peer, for slots that are filled
+		self.indexes = {} # peer -> set of indexes it fills
+		self.offsets = [] # sorted distances from us to each distinct peer
+		self.order = [] # peers, in the same order as offsets
+		self.checked = {} # index -> when a lookup last confirmed its slot
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, i):
+		return self.slots.get(i)
+
+	def __setitem__(self, i, peer):
+		old = self.slots.get(i)
+		if old == peer:
+			return
+		if old:
+			del self.slots[i]
+			self.checked.pop(i, None)
+			self.indexes[old].discard(i)
+			if len(self.indexes[old]) == 0:
+				# last slot it was in; forget about it
+				del self.indexes[old]
+				pos = self.order.index(old)
+				del self.order[pos]
+				del self.offsets[pos]
+		if peer:
+			self.slots[i] = peer
+			if peer not in self.indexes:
+				self.indexes[peer] = set()
+				offset = id_distance(self.my_id, node_id(peer))
+				pos = bisect.bisect_left(self.offsets, offset)
+				self.offsets.insert(pos, offset)
+				self.order.insert(pos, peer)
+			self.indexes[peer].add(i)
+
+	# distinct peers in the table
+	def peers(self):
+		return self.order
+
+	# indexes filled by peer
+	def slots_of(self, peer):
+		return sorted(self.indexes.get(peer, ()))
+
+	# the finger furthest along that's still short of dist from us, or None
+	def closest_preceding(self, dist):
+		pos = bisect.bisect_left(self.offsets, dist) - 1
+		if pos < 0:
+			return None
+		return self.order[pos]
+
+	# up to n fingers short of dist from us, furthest along first
+	def preceding(self, dist, n):
+		pos = bisect.bisect_left(self.offsets, dist)
+		return self.order[max(pos - n, 0):pos][::-1]
+
+	# a lookup says peer is the first node at or after slot i's target. the
+	# same goes for every later slot whose target comes before peer, so fill
+	# those too. returns the first slot it doesn't settle
+	def cover(self, i, peer):
+		end = min(id_distance(self.my_id, node_id(peer)).bit_length(), self.size)
+		now = time.time()
+		for j in xrange(i, max(end, i + 1)):
+			self[j] = peer
+			self.checked[j] = now
+		return max(end, i + 1)
+
+	# guess empty slots from peers someone else knows about, e.g. our
+	# successor's fingers, which point at much the same places as ours. their
+	# table can point at us, but we're never a finger of our own
+	def seed(self, peers):
+		peers = [p for p in set(peers) if node_id(p) != self.my_id]
+		peers.sort(key=lambda p: id_distance(self.my_id, node_id(p)))
+		offsets = [id_distance(self.my_id, node_id(p)) for p in peers]
+		for i in xrange(1, self.size):
+			pos = bisect.bisect_left(offsets, 2 ** i)
+			if pos < len(peers) and not self[i]:
+				self[i] = peers[pos]
+
+	# (first, last) slot of each run of slots holding the same peer (or none),
+	# leaving out finger[0], which stabilization keeps up to date
+	def runs(self):
+		ret = []
+		for i in xrange(1, self.size):
+			if ret and self[i] == self[ret[-1][0]]:
+				ret[-1][1] = i
+			else:
+				ret.append([i, i])
+		return ret
+
+	# the slot that has gone longest without a lookup confirming it
+	def stale(self):
+		return min(xrange(1, self.size), key=lambda i: self.checked.get(i, 0))
+
+# smoothed round trip time to a peer, and how long to wait for a reply
+# before resending; computed the way TCP does it (RFC 6298)
+class Rtt:
+	INITIAL = 1.0 # timeout before we have any samples
+	MIN = 0.05
+	MAX = 4.0
+
+	def __init__(self):
+		self.srtt = None
+		self.rttvar = None
+
+	def sample(self, r):
+		if self.srtt is None:
+			self.srtt = r
+			self.rttvar = r / 2
+		else:
+			self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - r)
+			self.srtt = 0.875 * self.srtt + 0.125 * r
+
+	def timeout(self):
+		if self.srtt is None:
+			return Rtt.INITIAL
+		return min(max(self.srtt + 4 * self.rttvar, Rtt.MIN), Rtt.MAX)
+
+# an iterative lookup: rather than passing a FIND along, we ask peers for
+# the next hop ourselves with NEXT, and they answer HOP (try these, closer to
+# the key) or OWNER (my successor owns it). up to ALPHA queries are out at
+# once; one that isn't answered within the peer's Rtt timeout is sent again,
+# backing off, up to RETRIES times before we give up on that peer. if we run
+# out of peers to ask, we fall back to a recursive FIND
+class Lookup:
+	ALPHA = 3
+	RETRIES = 2
+
+	next = 0 # incrementing count of queries, for query ids
+
+	def __init__(self, main, hash, transid):
+		self.main = main
+		self.hash = hash
+		self.transid = transid
+		self.key = parse_id(hash)
+		self.candidates = [] # (distance to key, peer) for peers to ask, closest first
+		self.asked = set()
+		self.queries = {} # query id -> [peer, time sent, tries, timer]
+
+	# start with peers if given (when we're joining, and our own finger table
+	# is empty), otherwise our finger table is the first hop
+	def start(self, peers=None):
+		if not peers:
+			peers = self.main.finger.preceding(id_distance(self.main.my_id, self.key), Lookup.ALPHA)
+		if not peers:
+			self.main.found_locally(self.hash, self.transid)
+			return
+		self.add(peers)
+		self.fill()
+
+	def add(self, peers):
+		for peer in peers:
+			if peer in self.asked or peer == self.main.myname:
+				continue
+			c = (id_distance(node_id(peer), self.key), peer)
+			if c not in self.candidates:
+				bisect.insort(self.candidates, c)
+
+	# keep ALPHA queries going, if we have the candidates
+	def fill(self):
+		while len(self.queries) < Lookup.ALPHA and self.candidates:
+			(_, peer) = self.candidates.pop(0)
+			self.asked.add(peer)
+			qid = '%s/%d' % (self.main.myname, Lookup.next)
+			Lookup.next += 1
+			self.queries[qid] = [peer, 0, 0, None]
+			self.main.lookups[qid] = self
+			self.send(qid)
+		if not self.queries:
+			print 'iterative lookup for %s ran out of peers; trying a FIND' % self.hash
+			self.main.find_forward(self.hash, self.main.myname, self.transid)
+
+	def send(self, qid):
+		q = self.queries[qid]
+		wait = self.main.rtt(q[0]).timeout() * 2 ** q[2]
+		q[1] = time.time()
+		q[2] += 1
+		q[3] = Timer(wait, lambda: self.expire(qid))
+		q[3].add()
+		self.main.dgram_socket.send(q[0], ['NEXT', self.hash, self.main.myname, qid])
+
+	def expire(self, qid):
+		if self.queries[qid][2] <= Lookup.RETRIES:
+			self.send(qid)
+			return
+		print 'lookup query %s to %s timed out' % (qid, self.queries[qid][0])
+		self.forget(qid)
+		self.fill()
+
+	def forget(self, qid):
+		q = self.queries.pop(qid)
+		q[3].remove()
+		del self.main.lookups[qid]
+		return q
+
+	# HOP: peers closer to the key
+	def on_hop(self, qid, peers):
+		q = self.forget(qid)
+		if q[2] == 1: # can't tell which send a reply to a resend is for
+			self.main.rtt(q[0]).sample(time.time() - q[1])
+		self.add(peers)
+		self.fill()
+
+	# OWNER: done
+	def on_owner(self, qid, owner, replicas):
+		q = self.forget(qid)
+		if q[2] == 1:
+			self.main.rtt(q[0]).sample(time.time() - q[1])
+		self.cancel()
+		self.main.owner_cache.add(self.key, owner, replicas)
+		self.main.handle_found(self.hash, owner, self.transid, replicas)
+
+	def cancel(self):
+		for qid in self.queries.keys():
+			self.forget(qid)
+		self.candidates = []
 
 class Main:
+	# client commands that start a transaction; see TransTable.admit
+	CLIENT_CMDS = ('CGET', 'CPUT', 'CSHOW', 'CCOMMIT', 'CFETCH', 'CMGET', 'CMPUT')
+	# datagrams that name the peer sending them, and which arg has the name;
+	# any of these counts as hearing from it (see ping_timer_cb). FIND and
+	# SHOW name whoever started them, not the peer passing them on
+	SENDER_ARG = {'GETP': 1, 'GETS': 1, 'GETF': 1, 'FINGERS': 1, 'NOTIFY': 1,
+		'PEER': 1, 'PING': 1, 'PONG': 1, 'NEXT': 2}
+
 	def __init__(self):
 		self.DEBUG = False
 
 	# start node
 	def start(self, options):
 		self.myname = options['listen_addr']
+		self.my_id = node_id(self.myname)
 		self.prev = None # previous peer in DHT
 		self.succsucc = None # successor of my successor; in case successor fails
-		self.finger = [None] * 160 # list of finger connections, in order of distance; finger[0] is next node
+		self.succs = [] # successor list from our successor; see successors()
+		self.finger = FingerTable(self.my_id) # finger connections, in order of distance; finger[0] is next node
 
-		# number of consecutive ping rounds a peer has not responded
-		# after 2 rounds, we consider it dead
-		self.ping_fail = {}
+		self.heard = {} # peer -> when we last heard anything from it
+		self.probes = {} # peer -> [when we last heard from it, pings since, when we sent the last one]
+		self.interval = PROBE_MIN # current probe interval; see PROBE_MIN
+		self.view = None # (finger[0], prev, succs) at the last probe round
 
-		self.items = {} # items stored at this node
-		self.trans = {} # list of active transactions: {id: Trans}
+		# items stored at this node. kept in memory unless PLMAN_STORE names a
+		# directory to keep them in, in which case they survive restarts
+		self.items = open_store(os.environ.get('PLMAN_STORE'), COMPRESS)
+		self.trans = TransTable(self) # active transactions: {id: Trans}
+		self.pumps = {} # long replies still being written: {socket: generator of messages left to send}
+		self.uploads = {} # chunked uploads from clients: {id: Upload}
+		self.incoming = {} # chunked PUTs we're receiving: {socket: (transid, store writer, hash so far, whether it's a copy)}
+		self.holds = {} # client socket -> owner socket we stop reading while the client is backed up
+		self.pool = ConnPool(self) # connections for requests to other peers
+		self.owner_cache = OwnerCache()
+		self.value_cache = ValueCache()
+		self.lookups = {} # iterative lookups waiting on queries: {query id: Lookup}
+		self.rtts = {} # peer -> Rtt
+		self.pooled = set() # connections from other peers' pools; kept open after replying
 
 		self.timers = {} # timers, so that we can remove them when stopping
 		self.sockets = set() # set of sockets so we can shut all of them down
@@ -83,6 +777,18 @@ class Main:
 		self.listen_sock = options['listen_sock']
 		self.dgram_socket = options['dgram_socket']
 
+		# channels to worker processes sharing our listen port, if any,
+		# and the client connections they're relaying to us: {(chan, connid): RelaySocket}
+		self.workers = set()
+		self.relays = {}
+		self.worker_caches = {} # chan -> (worker's pid, its ValueCache's counts), as of its last VCACHE
+		for s in options.get('worker_socks', []):
+			w = StreamSocket(s, self)
+			w.binary = True # internal, so no need to negotiate
+			# keep reading when backed up, so PAUSE/RESUME still get through
+			w.stop_reads = False
+			self.workers.add(w)
+
 		# set up timers
 		tl = []
 		tl.append(('ping', self.ping_timer_cb))
@@ -99,17 +805,29 @@ class Main:
 			bootpeer = options['boot_peer']
 			t = Trans(Trans.FINGER, self, 0)
 			t.add()
-			self.dgram_socket.send(bootpeer, ['FIND', make_id(self.myname), self.myname, t.id]) # find our successor
+			# find our successor
+			if LOOKUP_MODE == 'iterative':
+				Lookup(self, format_id(self.my_id), t.id).start([bootpeer])
+			else:
+				self.dgram_socket.send(bootpeer, ['FIND', format_id(self.my_id), self.myname, t.id])
 		else:
 			self.finger[0] = self.myname
 			self.prev = self.myname
 
-		print 'started', make_id(self.myname), self.myname
+		print 'started', format_id(self.my_id), self.myname
 
 	# stop node
 	def stop(self):
 		self.listen_sock.close()
 		self.dgram_socket.close()
+		for u in self.uploads.values():
+			u.close()
+		self.uploads = {}
+		self.pool.close()
+		self.trans.close()
+		for l in set(self.lookups.values()):
+			l.cancel()
+		self.items.close()
 
 		# delete timers
 		for t in self.timers.values():
@@ -123,61 +841,136 @@ class Main:
 
 	# the optional features we want enabled
 	def options(self):
-		return set(['listen_sock', 'listen_addr', 'dgram_socket', 'boot_peer'])
+		return set(['listen_sock', 'listen_addr', 'dgram_socket', 'boot_peer', 'workers'])
+
+	# client object for worker processes
+	def make_worker(self):
+		return Worker()
 
 	def on_connect(self, socket):
 		self.sockets.add(socket)
+		socket.values = VALUE_ARG
 
 	def on_error(self, socket):
 		self.sockets.discard(socket)
+		self.pumps.pop(socket, None)
+		self.pool.discard(socket)
+		self.pooled.discard(socket)
+		if socket in self.incoming:
+			self.incoming.pop(socket)[1].abort()
+		if socket in self.holds:
+			# client went away in the middle of a CFETCH
+			self.holds.pop(socket).close()
+
+		if socket in self.workers:
+			print 'lost worker %s' % socket
+			self.workers.discard(socket)
+			self.worker_caches.pop(socket, None)
+			# everything it was relaying is gone too
+			for key in self.relays.keys():
+				if key[0] == socket:
+					self.on_error(self.relays.pop(key))
 
 		# client disconnected.... whatever, just remove its transactions
 		for i in self.trans.values():
-			def is_client_type(t):
-				return t == Trans.GET or t == Trans.PUT or t == Trans.SHOW
-			if is_client_type(i.type) and i.client == socket:
+			if i.id not in self.trans:
+				continue # went with an earlier one
+			if i.type == Trans.GET and socket in i.asked:
+				self.replica_failed(i, socket, 'peer.failed')
+				continue
+			if i.type == Trans.PUT and i.sock == socket and i.cached:
+				self.uncache(i)
+				continue
+			if i.type in (Trans.PUT, Trans.UPLOAD, Trans.FETCH) and i.sock == socket:
+				i.client.write(['CERROR', 'peer.failed'])
+				i.client.close_when_done()
+				i.remove()
+				continue
+			if i.type in (Trans.MGET, Trans.MPUT) and socket in i.sent:
+				for hashes in i.sent.pop(socket):
+					for hash in hashes:
+						i.client.write(['CMERROR', hash, 'peer.failed'])
+				self.batch_answered(i, None)
+				continue
+			if i.is_client() and i.client == socket:
 				print '%s disconnected, purging transaction %s' % (socket, i.id)
-				t.remove()
+				i.remove()
 
 	# called when data received from server (UDP) port
 	def on_dgram(self, socket, data):
 		args = data.split(' ')
 		if self.DEBUG: print 'inU: %s\n' % ' '.join(args)
+		if args[0] in Main.SENDER_ARG and len(args) > Main.SENDER_ARG[args[0]]:
+			self.heard[args[Main.SENDER_ARG[args[0]]]] = time.time()
 
 		# server->server UDP commands:
 		# FIND hash ip:port transid -- server at ip:port wants to know who's responsible for the given hash
-		# FOUND hash ip:port transid -- server at ip:port is responsible for your requested hash
+		# FOUND hash ip:port transid replica... -- server at ip:port is responsible for your requested hash, and these servers have copies
 		# GETP ip:port -- ip:port wants your predecessor
+		# GETS ip:port -- ip:port wants your successor list
+		# SUCCS ip:port... -- successor list, first one first
+		# GETF ip:port -- ip:port wants the peers in your finger table
+		# FINGERS ip:port peer... -- reply to GETF from ip:port
 		# NOTIFY ip:port -- set predecessor to ip:port (suggestion)
 		# PRED ip:port -- predecessor is ip:port
 		# SHOW ip:port transid -- send ip:port information about yourself (sent around ring)
 		# PEER ip:port transid -- response to SHOW
-		# PING ip:port -- ping request from ip:port
-		# PONG ip:port -- ping reply from ip:port
+		# NEXT hash ip:port qid -- iterative lookup: who should ip:port ask next about hash?
+		# HOP hash qid ip:port... -- reply to NEXT: these peers are closer to hash, closest first
+		# OWNER hash qid ip:port replica... -- reply to NEXT: ip:port owns hash, and these servers have copies
+		# PING ip:port stamp -- ping request from ip:port
+		# PONG ip:port stamp -- ping reply from ip:port, echoing the request's stamp
 		if args[0] == 'FIND':
 			(hash, peer, transid) = args[1:]
 			self.find_forward(hash, peer, transid)
 		elif args[0] == 'FOUND':
-			(hash, peer, transid) = args[1:]
-			self.handle_found(hash, peer, transid)
+			(hash, peer, transid) = args[1:4]
+			self.owner_cache.add(parse_id(hash), peer, args[4:])
+			self.handle_found(hash, peer, transid, args[4:])
+		elif args[0] == 'NEXT':
+			(hash, peer, qid) = args[1:]
+			peers = self.finger.preceding(id_distance(self.my_id, parse_id(hash)), Lookup.ALPHA)
+			if peers:
+				self.dgram_socket.send(peer, ['HOP', hash, qid] + peers)
+			else:
+				self.dgram_socket.send(peer, ['OWNER', hash, qid, self.finger[0] or self.myname] + self.successors()[1:])
+		elif args[0] == 'HOP':
+			qid = args[2]
+			if qid in self.lookups:
+				self.lookups[qid].on_hop(qid, args[3:])
+		elif args[0] == 'OWNER':
+			(qid, peer) = args[2:4]
+			if qid in self.lookups:
+				self.lookups[qid].on_owner(qid, peer, args[4:])
 		elif args[0] == 'GETP':
 			peer = args[1]
 			if self.prev:
 				self.dgram_socket.send(peer, ['PRED', self.prev])
+		elif args[0] == 'GETS':
+			peer = args[1]
+			self.dgram_socket.send(peer, ['SUCCS'] + self.successors())
+		elif args[0] == 'SUCCS':
+			old = self.successors()[:REPLICAS-1]
+			self.succs = args[1:]
+			# peers that just became replicas for us need our items
+			for peer in self.successors()[:REPLICAS-1]:
+				if peer not in old:
+					self.push_owned(peer)
+		elif args[0] == 'GETF':
+			peer = args[1]
+			self.dgram_socket.send(peer, ['FINGERS', self.myname] + self.finger.peers())
+		elif args[0] == 'FINGERS':
+			# our successor's table, to start ours from; see build_fingers
+			self.finger.seed(args[1:])
+			self.build_fingers()
 		elif args[0] == 'NOTIFY':
 			peer = args[1]
-			my_id = make_id(self.myname)
-			prev_id = self.prev and make_id(self.prev) or None
-			peer_id = make_id(peer)
-			if not self.prev or id_distance(peer_id, my_id) < id_distance(prev_id, my_id):
+			if not self.prev or id_distance(node_id(peer), self.my_id) < id_distance(node_id(self.prev), self.my_id):
 				print 'updating prev:', peer
 				self.prev = peer
 		elif args[0] == 'PRED':
 			peer = args[1]
-			my_id = make_id(self.myname)
-			succ_id = make_id(self.finger[0])
-			peer_id = make_id(peer)
-			if id_distance(my_id, peer_id) < id_distance(my_id, succ_id):
+			if id_distance(self.my_id, node_id(peer)) < id_distance(self.my_id, node_id(self.finger[0])):
 				print 'updating finger[0] from succ.pred:', peer
 				self.finger[0] = peer
 		elif args[0] == 'SHOW':
@@ -190,33 +983,65 @@ class Main:
 				self.dgram_socket.send(peer, ['PEER', self.myname, transid])
 		elif args[0] == 'PEER':
 			(peer, transid) = args[1:]
-			t = self.trans[transid]
-			t.client.write(['CPEER', make_id(peer), peer])
+			t = self.trans.get(transid)
+			if t: # SHOW may be over
+				t.client.write(['CPEER', format_id(node_id(peer)), peer])
 		elif args[0] == 'PING':
 			# reply to ping
 			peer = args[1]
-			self.dgram_socket.send(args[1], ['PONG', self.myname])
+			self.dgram_socket.send(peer, ['PONG', self.myname] + args[2:3])
 		elif args[0] == 'PONG':
 			peer = args[1]
-			self.ping_fail[peer] = 0
+			if len(args) > 2:
+				self.rtt(peer).sample(max(time.time() - float(args[2]), 0))
 		else:
 			print 'unknown message:', ' '.join(args)
 
-	def handle_found(self, hash, peer, transid):
+	def handle_found(self, hash, peer, transid, replicas=[]):
 		if transid not in self.trans:
 			print 'received message for bad trans %s: FOUND %s %s' % (transid, hash, peer)
 			return
 
 		t = self.trans[transid]
-		if t.type == Trans.GET:
-			s = self.connect(peer)
-			s.write(['GET', hash, transid])
+		if t.type == Trans.LOOKUP:
+			# worker will contact the owner itself
+			t.client.write(['FOUND', hash, peer, t.index] + replicas)
+			t.remove()
+		elif t.type == Trans.GET:
+			t.hash = hash
+			t.replicas = [peer] + replicas
+			self.try_replica(t)
 		elif t.type == Trans.PUT:
-			s = self.connect(peer)
-			s.write(['PUT', base64.b64encode(t.data), transid])
+			t.sock = self.pool.get(peer)
+			(codec, data) = t.data
+			if t.cached:
+				# let the owner tell us if it isn't any more
+				t.sock.write(['PUT', data, codec, transid, 'cached'])
+			else:
+				t.sock.write(['PUT', data, codec, transid])
+		elif t.type == Trans.UPLOAD:
+			# streams get a connection to themselves, so they don't hold up
+			# other requests to the same peer
+			s = t.sock = self.connect(peer)
+			s.write(['PBEGIN', transid])
+			self.pumps[s] = self.upload_msgs(t)
+			self.pump(s)
+		elif t.type == Trans.MGET or t.type == Trans.MPUT:
+			# the batch's lookups all share its transid; tell them apart by hash
+			if hash in t.waiting:
+				t.waiting.discard(hash)
+				t.owners.setdefault(peer, []).append(hash)
+				self.queue_batch(t)
+		elif t.type == Trans.FETCH:
+			s = t.sock = self.connect(peer)
+			(offset, length) = t.range
+			s.write(['FETCH', hash, offset, length, transid])
+			self.holds[t.client] = s
 		elif t.type == Trans.FINGER:
+			t.remove()
 			# don't add ourself to the finger table, we'll get used as fallback anyway
 			if peer == self.myname:
+				self.finger.checked[t.index] = time.time()
 				return
 			# we found the finger node for a specific index
 			if peer != self.finger[t.index]:
@@ -226,9 +1051,14 @@ class Main:
 				s = self.connect(peer)
 				# cute trick: we don't need to know our predecessor, we just ask for
 				# everything but the space between us and our successor!
-				s.write(['RETR', make_id(peer), make_id(self.myname)])
-			self.finger[t.index] = peer
-			t.remove()
+				s.write(['RETR', format_id(node_id(peer)), format_id(self.my_id)])
+				self.finger[0] = peer
+				# we've just joined; get the rest of the table going
+				self.dgram_socket.send(peer, ['GETF', self.myname])
+				return
+			following = self.finger.cover(t.index, peer)
+			if t.end is not None and following <= t.end:
+				self.find_finger(following, t.end)
 		elif t.type == Trans.BACKUP:
 			# update our successor's successor (for fault tolerance)
 			if self.succsucc != peer:
@@ -244,35 +1074,71 @@ class Main:
 
 	# called when data received from client (TCP) port
 	def on_data(self, socket, data):
-		pos = data.find('\n')
-		if pos < 0: # need to wait for new line
-			return 0
-		elif pos == 0:
-			return 1 # just a keep-alive
+		(ret, args) = socket.next_msg(data)
+		if not args: # incomplete, or nothing for us to do
+			return ret
 
-		args = data[0:pos].split(' ')
 		if self.DEBUG: print 'inT:', ' '.join(args)
 
+		if socket in self.workers:
+			self.on_worker(socket, args)
+			return ret
+		if socket in self.pool.peers:
+			# replies on our pooled connections count as hearing from the peer
+			self.heard[self.pool.peers[socket]] = time.time()
+			self.pool.touch(socket)
+
+		if args[0] in Main.CLIENT_CMDS and not self.trans.admit():
+			socket.write(['CERROR', 'busy'])
+			socket.close_when_done()
+			return ret
+
+		# peers talking to each other upgrade their connection to binary
+		# frames (see StreamSocket.next_msg); clients can stick to text lines.
+		# values (marked "data") are base64-encoded in text mode
 		# client->server commands:
-		# CGET hash -- get value with specified hash
+		# CGET hash [codec...] -- get value with specified hash; it may come compressed with any of the codecs given
 		# CPUT data -- put data into hash table (base64-encoded)
 		# CSHOW -- request a listing of all nodes
+		# STATS -- event loop statistics, one STAT line each, ending with STAT end
+		# for values too big to send in one message:
+		# CUPLOAD -- start a chunked upload
+		# CCHUNK upid seq data -- next piece of the upload; seq counts up from 0
+		# CRESUME upid -- carry on with an upload after losing the connection (same node only)
+		# CCOMMIT upid -- upload is complete; store it
+		# CFETCH hash offset length -- get length bytes of value from offset (to the end if length is -1)
+		# batches, for many values at once:
+		# CMGET hash... -- get values with these hashes
+		# CMPUT data... -- put these values (each one base64-encoded, even on a binary connection)
 		# server->client commands:
 		# CERROR msg -- there was some kind of error
-		# CDATA data -- data that was stored (base64-encoded)
+		# CDATA data [codec] -- data that was stored (base64-encoded), and what it's compressed with, if anything
 		# COK hash -- insert succeeded
 		# CPEER hash ip:port -- peer in system
+		# CUPID upid -- upload started
+		# CACK upid seq -- chunks up to seq have been received
+		# CPART offset data -- piece of a value, in answer to CFETCH
+		# CEND size -- end of CFETCH; size is that of the whole value
+		# CMDATA hash data -- a value asked for by CMGET; these come as owners answer
+		# CMOK hash -- a value from CMPUT was stored
+		# CMERROR hash msg -- couldn't get or put this one
+		# CMEND -- all of the CMGET or CMPUT has been answered
 		if args[0] == 'CGET':
 			hash = args[1]
-			t = Trans(Trans.GET, self, socket)
+			hit = self.value_cache.get(hash)
+			if hit:
+				socket.write(['CDATA'] + client_value(hit[1], hit[0], args[2:]))
+				socket.close_when_done()
+				return ret
+			t = Trans(Trans.GET, self, socket, args[2:])
 			t.add()
-			self.find(hash, t.id)
+			self.route(t, hash)
 		elif args[0] == 'CPUT':
-			to_add = base64.b64decode(args[1])
+			to_add = args[1]
 			hash = make_file_id(to_add)
-			t = Trans(Trans.PUT, self, socket, to_add)
+			t = Trans(Trans.PUT, self, socket, self.items.pack(to_add))
 			t.add()
-			self.find(hash, t.id)
+			self.route(t, hash)
 		elif args[0] == 'CSHOW':
 			t = Trans(Trans.SHOW, self, socket)
 			t.add()
@@ -280,82 +1146,594 @@ class Main:
 				# we can have trouble here if a node just joined and our successor
 				# has not been updated to reflect that
 				self.dgram_socket.send(self.finger[0], ['SHOW', self.myname, t.id])
-			socket.write(['CPEER', make_id(self.myname), self.myname])
+			socket.write(['CPEER', format_id(self.my_id), self.myname])
+		elif args[0] == 'STATS':
+			lines = Stats.report()
+			caches = [ValueCache.report('valuecache', self.value_cache.counts())]
+			for (pid, counts) in sorted(self.worker_caches.values()):
+				caches.append(ValueCache.report('valuecache.worker%s' % pid, counts))
+			for i in lines[:-1] + self.trans.report() + caches + lines[-1:]:
+				socket.write(i)
+			socket.close_when_done()
+		elif args[0] == 'CUPLOAD':
+			u = Upload(self)
+			self.uploads[u.id] = u
+			socket.write(['CUPID', u.id])
+		elif args[0] == 'CCHUNK':
+			(upid, seq, data) = args[1:]
+			u = self.uploads.get(upid)
+			if not u:
+				socket.write(['CERROR', 'upload.not.found'])
+				socket.close_when_done()
+			elif int(seq) > u.seq + 1:
+				socket.write(['CERROR', 'chunk.out.of.order'])
+				socket.close_when_done()
+			elif int(seq) <= u.seq:
+				# resent after a lost ack; we already have it
+				socket.write(['CACK', upid, seq])
+			else:
+				u.add(data)
+				socket.write(['CACK', upid, seq])
+		elif args[0] == 'CRESUME':
+			upid = args[1]
+			if upid in self.uploads:
+				socket.write(['CACK', upid, str(self.uploads[upid].seq)])
+			else:
+				socket.write(['CERROR', 'upload.not.found'])
+				socket.close_when_done()
+		elif args[0] == 'CCOMMIT':
+			upid = args[1]
+			if upid in self.uploads:
+				u = self.uploads.pop(upid)
+				u.timer.remove()
+				u.timer = None
+				t = Trans(Trans.UPLOAD, self, socket, u)
+				t.add()
+				self.find(u.hash.hexdigest(), t.id)
+			else:
+				socket.write(['CERROR', 'upload.not.found'])
+				socket.close_when_done()
+		elif args[0] == 'CFETCH':
+			(hash, offset, length) = args[1:]
+			t = Trans(Trans.FETCH, self, socket, (offset, length))
+			t.add()
+			self.find(hash, t.id)
+		elif args[0] == 'CMGET':
+			t = Trans(Trans.MGET, self, socket, dict.fromkeys(args[1:]))
+			self.start_batch(t)
+		elif args[0] == 'CMPUT':
+			values = {}
+			for i in args[1:]:
+				data = base64.b64decode(i)
+				values[make_file_id(data)] = pack(data, COMPRESS)
+			t = Trans(Trans.MPUT, self, socket, values)
+			self.start_batch(t)
 		# get/put operations done over TCP because data could be larger than 1 packet
+		# values between peers go as they're stored: codec is what data is
+		# compressed with, or "raw"
 		# GET hash transid -- request for data
-		# DATA data transid -- hash and its data (sent in response to GET)
+		# DATA data codec transid -- hash and its data (sent in response to GET)
 		# ERROR msg transid -- there was an error
-		# PUT data transid -- data to insert (hash calculated at inserting node)
+		# PUT data codec transid [cached] -- data to insert (hash calculated at inserting node);
+		#   "cached" means check that it's ours, and reply ERROR not.owner if not
 		# OK hash transid -- insert succeeded
+		# POOL -- connection is from a ConnPool; leave it open after replying
+		elif args[0] == 'POOL':
+			self.pooled.add(socket)
+			if socket in self.sockets: # not a RelaySocket; the worker does it for those
+				no_delay(socket)
 		elif args[0] == 'GET':
 			(hash, transid) = args[1:]
 			if hash in self.items:
-				socket.write(['DATA', base64.b64encode(self.items[hash]), transid])
+				(codec, data) = self.items.packed(hash)
+				socket.write(['DATA', data, codec, transid])
 			else:
 				socket.write(['ERROR', 'data.not.found', transid])
-			socket.close_when_done()
+			self.reply_done(socket)
 		elif args[0] == 'DATA':
-			(data, transid) = args[1:]
-			t = self.trans[transid]
-			t.client.write(['CDATA', data])
+			(data, codec, transid) = args[1:]
+			t = self.trans.get(transid)
+			if not t:
+				return ret # another replica answered first
+			self.value_cache.add(t.hash, codec, data)
+			t.client.write(['CDATA'] + client_value(data, codec, t.codecs))
 			t.client.close_when_done()
 			t.remove()
 		elif args[0] == 'ERROR':
 			(msg, transid) = args[1:]
-			t = self.trans[transid]
+			t = self.trans.get(transid)
+			if not t:
+				return ret
+			if t.type == Trans.GET:
+				self.replica_failed(t, socket, msg)
+				return ret
+			if t.type == Trans.PUT and socket != t.sock:
+				return ret # from an attempt we've given up on
+			if t.type == Trans.PUT and t.cached:
+				self.uncache(t)
+				return ret
 			t.client.write(['CERROR', msg])
 			t.client.close_when_done()
 			t.remove()
 		elif args[0] == 'PUT':
-			(data, transid) = args[1:]
-			data = base64.b64decode(data)
-			hash = make_file_id(data)
+			(data, codec, transid) = args[1:4]
+			hash = make_file_id(unpack(codec, data))
+			if len(args) > 4 and not self.owns(hash):
+				socket.write(['ERROR', 'not.owner', transid])
+				self.reply_done(socket)
+				return ret
 			print 'adding %s' % hash
-			self.items[hash] = data
+			self.items.put_packed(hash, codec, data)
+			self.replicate(hash)
 			socket.write(['OK', hash, transid])
-			socket.close_when_done()
+			self.reply_done(socket)
 		elif args[0] == 'OK':
 			(hash, transid) = args[1:]
-			t = self.trans[transid]
+			t = self.trans.get(transid)
+			if not t:
+				return ret # client went away
 			t.client.write(['COK', hash])
 			t.client.close_when_done()
 			t.remove()
+		# batches; values for several hashes go in one blob, one after another,
+		# each as it's stored (codec as for PUT and DATA)
+		# MGET transid hash... -- request for these values
+		# MDATA blob transid hash size codec... -- response to MGET (size is -1 for ones we don't have)
+		# MPUT blob transid size codec... -- values to insert
+		# MOK transid hash... -- those values were inserted
+		elif args[0] == 'MGET':
+			transid = args[1]
+			found = []
+			index = []
+			for hash in args[2:]:
+				if hash in self.items:
+					(codec, data) = self.items.packed(hash)
+					found.append(data)
+					index += [hash, str(len(data)), codec]
+				else:
+					index += [hash, '-1', RAW]
+			socket.write(['MDATA', found, transid] + index)
+			self.reply_done(socket)
+		elif args[0] == 'MDATA':
+			(blob, transid) = args[1:3]
+			t = self.trans.get(transid)
+			if not t:
+				return ret # client went away
+			pos = 0
+			for i in xrange(3, len(args), 3):
+				(hash, size, codec) = (args[i], int(args[i+1]), args[i+2])
+				if size < 0:
+					t.client.write(['CMERROR', hash, 'data.not.found'])
+				else:
+					t.client.write(['CMDATA', hash] + client_value(buffer(blob, pos, size), codec, ()))
+					pos += size
+			self.batch_answered(t, socket)
+		elif args[0] == 'MPUT':
+			(blob, transid) = args[1:3]
+			pos = 0
+			hashes = []
+			for i in xrange(3, len(args), 2):
+				(size, codec) = (int(args[i]), args[i+1])
+				data = blob[pos:pos+size]
+				pos += size
+				hash = make_file_id(unpack(codec, data))
+				print 'adding %s' % hash
+				self.items.put_packed(hash, codec, data)
+				self.replicate(hash)
+				hashes.append(hash)
+			socket.write(['MOK', transid] + hashes)
+			self.reply_done(socket)
+		elif args[0] == 'MOK':
+			transid = args[1]
+			t = self.trans.get(transid)
+			if not t:
+				return ret
+			for hash in args[2:]:
+				t.client.write(['CMOK', hash])
+			self.batch_answered(t, socket)
+		# chunked transfers; replies are OK and ERROR as above
+		# PBEGIN transid [copy] -- a value follows in PCHUNKs (hash calculated as they arrive);
+		#   "copy" means it's for a replica, like XFER: no reply, and not passed on to our replicas
+		# PCHUNK transid data -- piece of the value
+		# PEND transid -- that's all of it
+		# FETCH hash offset length transid -- request for part of a value
+		# PART transid offset data -- piece of it (sent in response to FETCH)
+		# END transid size -- no more PARTs; size is that of the whole value
+		elif args[0] == 'PBEGIN':
+			transid = args[1]
+			self.incoming[socket] = (transid, self.items.writer(), hashlib.sha1('\x01'), len(args) > 2)
+		elif args[0] == 'PCHUNK':
+			(transid, data) = args[1:]
+			(_, writer, h, copy) = self.incoming[socket]
+			writer.write(data)
+			h.update(data)
+		elif args[0] == 'PEND':
+			(transid, writer, h, copy) = self.incoming.pop(socket)
+			hash = h.hexdigest()
+			print 'adding %s' % hash
+			writer.commit(hash)
+			if copy:
+				return ret
+			self.replicate(hash)
+			socket.write(['OK', hash, transid])
+			self.reply_done(socket)
+		elif args[0] == 'FETCH':
+			(hash, offset, length, transid) = args[1:]
+			if hash in self.items:
+				self.pumps[socket] = self.fetch_msgs(socket, hash, int(offset), int(length), transid)
+				self.pump(socket)
+			else:
+				socket.write(['ERROR', 'data.not.found', transid])
+				self.reply_done(socket)
+		elif args[0] == 'PART':
+			(transid, offset, data) = args[1:]
+			t = self.trans.get(transid)
+			if not t:
+				return ret
+			t.touch()
+			t.client.write(['CPART', offset, data])
+		elif args[0] == 'END':
+			(transid, size) = args[1:]
+			t = self.trans.get(transid)
+			if not t:
+				return ret
+			t.client.write(['CEND', size])
+			t.client.close_when_done()
+			t.remove()
 		# value transfers are done over TCP as well
 		# RETR low high -- ask for data in range (low, high]
-		# XFER hash data -- response to RETR (transferring data to new node)
+		# XFER hash data codec -- response to RETR (transferring data to new node), or a copy for a replica
 		elif args[0] == 'RETR':
 			(low, high) = args[1:]
-			for i in self.items.iterkeys():
-				if id_distance(low, i) < id_distance(low, high):
-					print 'transferring %s to peer' % i
-					socket.write(['XFER', i, base64.b64encode(self.items[i])])
-			socket.close_when_done()
+			self.pumps[socket] = self.retr_msgs(socket, low, high)
+			self.pump(socket)
 		elif args[0] == 'XFER':
-			(hash, data) = args[1:]
+			(hash, data, codec) = args[1:]
 			# add to database
-			self.items[hash] = base64.b64decode(data)
+			self.items.put_packed(hash, codec, data)
 		else:
 			print 'unknown message:', ' '.join(args)
 
-		return pos + 1
+		return ret
+
+	# called for messages from a worker process
+	def on_worker(self, socket, args):
+		# worker->coordinator commands:
+		# LOOKUP hash reqid -- find the owner of hash on behalf of the worker
+		# RELAY connid msg... -- msg arrived on a connection the worker accepted
+		# CLOSE connid -- that connection went away
+		# PAUSE connid -- that connection has more than its high water mark waiting to be sent
+		# RESUME connid -- it's back under its low water mark
+		# VCACHE pid entries bytes hits misses -- the worker's ValueCache counts, when they change
+		# coordinator->worker commands:
+		# FOUND hash ip:port reqid -- ip:port owns hash
+		# FAIL reqid msg -- couldn't look it up (busy, or timed out)
+		# RELAY connid msg... -- write msg to the connection
+		# CLOSE connid -- close the connection once written
+		if args[0] == 'LOOKUP':
+			(hash, reqid) = args[1:]
+			if not self.trans.admit():
+				socket.write(['FAIL', reqid, 'busy'])
+				return
+			t = Trans(Trans.LOOKUP, self, socket, reqid)
+			t.add()
+			self.find(hash, t.id)
+		elif args[0] == 'RELAY':
+			connid = args[1]
+			key = (socket, connid)
+			if key not in self.relays:
+				self.relays[key] = RelaySocket(self, socket, connid)
+			relay = self.relays[key]
+			relay.msg = args[2:]
+			self.on_data(relay, None)
+		elif args[0] == 'CLOSE':
+			connid = args[1]
+			if (socket, connid) in self.relays:
+				self.on_error(self.relays.pop((socket, connid)))
+		elif args[0] in ('PAUSE', 'RESUME'):
+			relay = self.relays.get((socket, args[1]))
+			if not relay:
+				return
+			relay.stopped = args[0] == 'PAUSE'
+			if relay.stopped:
+				self.on_pause(relay)
+			elif not relay.paused:
+				self.on_resume(relay)
+		elif args[0] == 'VCACHE':
+			self.worker_caches[socket] = (args[1], tuple(int(i) for i in args[2:6]))
+		else:
+			print 'unknown message from worker:', ' '.join(args)
+
+	# look up every hash in a CMGET/CMPUT at once
+	def start_batch(self, t):
+		t.add()
+		t.touch(Trans.BATCH_LOOKUP)
+		if not t.values:
+			self.send_batch(t)
+			return
+		for hash in t.values.keys():
+			self.find(hash, t.id)
+
+	# owners for some of a batch's hashes are in. ask them once the loop has
+	# been round, so the ones that come in together go to each owner as one
+	# request, rather than holding everything up until the last lookup
+	def queue_batch(self, t):
+		if not t.flush:
+			t.flush = Timer(0, lambda: self.send_batch(t))
+			t.flush.add()
+
+	# send each owner we've found one request for all of its hashes so far
+	def send_batch(self, t):
+		if t.flush:
+			t.flush.remove()
+			t.flush = None
+		if not t.waiting:
+			t.touch() # the lookups are done; the owners get the full deadline
+		for (peer, hashes) in t.owners.items():
+			s = self.pool.get(peer)
+			if t.type == Trans.MGET:
+				s.write(['MGET', t.id] + hashes)
+			else:
+				values = [t.values[h] for h in hashes]
+				index = []
+				for (codec, data) in values:
+					index += [str(len(data)), codec]
+				s.write(['MPUT', [data for (codec, data) in values], t.id] + index)
+			t.sent.setdefault(s, []).append(hashes)
+		t.owners = {}
+		self.batch_answered(t, None)
+
+	def batch_timeout(self, t):
+		for hash in t.waiting:
+			t.client.write(['CMERROR', hash, 'lookup.timeout'])
+		t.waiting = set()
+		self.send_batch(t)
+
+	# the owner on socket has answered its oldest request (replies on a
+	# connection come in order); finish once every owner has answered everything
+	def batch_answered(self, t, socket):
+		if socket in t.sent:
+			t.sent[socket].pop(0)
+			if not t.sent[socket]:
+				del t.sent[socket]
+		if not t.sent and not t.waiting:
+			t.client.write(['CMEND'])
+			t.client.close_when_done()
+			t.remove()
+
+	# t has run out of time (see TransTable)
+	def expire(self, t):
+		if t.type == Trans.SHOW:
+			# roll call is over; close client connection, we won't send it any more peers
+			t.client.close_when_done()
+			t.remove()
+			return
+		if t.type in (Trans.MGET, Trans.MPUT) and t.waiting:
+			# lookups can get lost; go ahead without the ones still out
+			self.batch_timeout(t)
+			return
+		print 'transaction %s timed out' % t.id
+		t.expired = True
+		if t.type == Trans.LOOKUP:
+			t.client.write(['FAIL', t.index, 'timeout'])
+		elif t.is_client():
+			t.client.write(['CERROR', 'timeout'])
+			t.client.close_when_done()
+		t.remove()
+
+	# we've answered a request from another peer
+	def reply_done(self, socket):
+		if socket not in self.pooled:
+			socket.close_when_done()
+
+	# socket has backed up; stop reading whatever is feeding it
+	def on_pause(self, socket):
+		if socket in self.holds:
+			self.holds[socket].hold()
+		if socket in self.workers:
+			for (key, relay) in self.relays.items():
+				if key[0] == socket:
+					self.on_pause(relay)
+
+	# socket has drained; carry on with whatever it was sending
+	def on_resume(self, socket):
+		if socket in self.holds:
+			self.holds[socket].release()
+		if socket in self.pumps:
+			self.pump(socket)
+		if socket in self.workers:
+			# relayed connections were held up behind this one too
+			for (key, relay) in self.relays.items():
+				if key[0] == socket and not relay.paused:
+					self.on_resume(relay)
+
+	# write messages from socket's pump until the socket backs up (on_resume
+	# will call us again) or we run out
+	def pump(self, socket):
+		it = self.pumps[socket]
+		while not socket.paused:
+			msg = next(it, None)
+			if msg is None:
+				self.pumps.pop(socket, None)
+				return
+			socket.write(msg)
+
+	# copies answering a RETR
+	def retr_msgs(self, socket, low, high):
+		return self.copy_msgs(socket, self.items.between(low, high))
+
+	# copies of the values for hashes, for a replica: each in an XFER, or
+	# for big ones a PBEGIN/PCHUNK/PEND stream, so that neither end has to
+	# hold a whole value in one message
+	def copy_msgs(self, socket, hashes):
+		for i in hashes:
+			if i not in self.items:
+				continue # may have been pruned since we were asked
+			print 'transferring %s to peer' % i
+			(codec, data) = self.items.packed(i)
+			if codec != RAW or len(data) <= CHUNK_SIZE:
+				yield ['XFER', i, data, codec]
+				continue
+			yield ['PBEGIN', i, 'copy']
+			for pos in xrange(0, len(data), CHUNK_SIZE):
+				yield ['PCHUNK', i, buffer(data, pos, CHUNK_SIZE)]
+			yield ['PEND', i]
+		socket.close_when_done()
+
+	# PARTs answering a FETCH. pieces are buffers into the stored value, so
+	# nothing is copied until it's written
+	def fetch_msgs(self, socket, hash, offset, length, transid):
+		value = self.items[hash]
+		end = len(value)
+		if length >= 0:
+			end = min(end, offset + length)
+		pos = max(offset, 0)
+		while pos < end:
+			n = min(CHUNK_SIZE, end - pos)
+			yield ['PART', transid, str(pos), buffer(value, pos, n)]
+			pos += n
+		yield ['END', transid, str(len(value))]
+		socket.close_when_done()
+
+	# PCHUNKs streaming an upload's spool to its owner
+	def upload_msgs(self, t):
+		for data in t.upload.pieces():
+			t.touch()
+			yield ['PCHUNK', t.id, data]
+		yield ['PEND', t.id]
+
+	# our successor, then its successors, without ourself (in a small ring the
+	# list comes back around to us). these are the replicas for our items
+	def successors(self):
+		ret = []
+		for peer in [self.finger[0]] + self.succs:
+			if peer and peer != self.myname and peer not in ret:
+				ret.append(peer)
+		return ret[:REPLICAS]
+
+	# send copies of a newly added item to our replicas. big ones are
+	# streamed, on connections of their own
+	def replicate(self, hash):
+		(codec, data) = self.items.packed(hash)
+		for peer in self.successors()[:REPLICAS-1]:
+			if codec != RAW or len(data) <= CHUNK_SIZE:
+				self.pool.get(peer).write(['XFER', hash, data, codec])
+			else:
+				s = self.connect(peer)
+				self.pumps[s] = self.copy_msgs(s, [hash])
+				self.pump(s)
+
+	# send everything we own to peer, which has just become one of our replicas
+	def push_owned(self, peer):
+		if not self.prev or self.prev == self.myname:
+			return # don't know what we own yet
+		s = self.connect(peer)
+		self.pumps[s] = self.retr_msgs(s, format_id(node_id(self.prev)), format_id(self.my_id))
+		self.pump(s)
+
+	# ask the next replica of t.hash for it. if it doesn't answer within
+	# HEDGE_DELAY we ask another as well, and take whichever answer comes
+	# first. returns False if there's nobody left to ask
+	def try_replica(self, t):
+		if t.hedge:
+			t.hedge.remove()
+			t.hedge = None
+		if not t.replicas:
+			return False
+		peer = t.replicas.pop(0)
+		s = self.pool.get(peer)
+		s.write(['GET', t.hash, t.id])
+		t.asked[s] = peer
+		if t.replicas:
+			delay = HEDGE_DELAY
+			if peer in self.rtts and self.rtts[peer].srtt is not None:
+				delay = max(delay, 2 * self.rtts[peer].srtt)
+			t.hedge = Timer(delay, lambda: self.try_replica(t))
+			t.hedge.add()
+		return True
+
+	# a replica couldn't answer GET t (error reply, or connection failed); fail
+	# the GET only when nobody else can
+	def replica_failed(self, t, socket, msg):
+		if socket not in t.asked:
+			return # from an attempt we've given up on
+		del t.asked[socket]
+		if self.try_replica(t) or t.asked:
+			return
+		if t.cached:
+			self.uncache(t)
+			return
+		t.client.write(['CERROR', msg])
+		t.client.close_when_done()
+		t.remove()
 
 	def find(self, hash, transid):
-		self.find_forward(hash, self.myname, transid)
+		if LOOKUP_MODE == 'iterative':
+			Lookup(self, hash, transid).start()
+		else:
+			self.find_forward(hash, self.myname, transid)
+
+	# no finger is closer to hash than we are, so our successor owns it
+	def found_locally(self, hash, transid):
+		if self.finger[0]:
+			self.handle_found(hash, self.finger[0], transid, self.successors()[1:])
+		else:
+			self.handle_found(hash, self.myname, transid)
+
+	def rtt(self, peer):
+		if peer not in self.rtts:
+			self.rtts[peer] = Rtt()
+		return self.rtts[peer]
+
+	# send GET/PUT t for hash to its owner: straight there if the OwnerCache
+	# knows it, otherwise after a lookup
+	def route(self, t, hash):
+		t.hash = hash
+		hit = self.owner_cache.lookup(parse_id(hash))
+		if not hit:
+			self.find(hash, t.id)
+			return
+		(peer, replicas) = hit
+		t.cached = True
+		t.retry = Timer(CACHE_TIMEOUT, lambda: self.uncache(t))
+		t.retry.add()
+		self.handle_found(hash, peer, t.id, replicas)
+
+	# the owner the cache gave for t turned it away, failed or is taking too
+	# long; forget the entry and do a real lookup
+	def uncache(self, t):
+		self.owner_cache.invalidate(parse_id(t.hash))
+		t.cached = False
+		if t.retry:
+			t.retry.remove()
+			t.retry = None
+		if t.type == Trans.PUT:
+			t.sock = None
+		if t.type == Trans.GET:
+			if t.hedge:
+				t.hedge.remove()
+				t.hedge = None
+			t.replicas = []
+			t.asked = {}
+		self.find(t.hash, t.id)
+
+	# are we responsible for hash, as far as we know?
+	def owns(self, hash):
+		if not self.prev or self.prev == self.myname:
+			return True
+		prev = node_id(self.prev)
+		return id_distance(prev, parse_id(hash)) <= id_distance(prev, self.my_id)
 
 	# peerid is looking for hash with transaction transid
 	def find_forward(self, hash, peerid, transid):
-		my_id = make_id(self.myname)
-		for i in reversed(self.finger):
-			if not i:
-				continue
-			other_id = make_id(i)
-			if id_distance(my_id, hash) > id_distance(my_id, other_id):
-				self.dgram_socket.send(i, ['FIND', hash, peerid, transid])
-				return
+		i = self.finger.closest_preceding(id_distance(self.my_id, parse_id(hash)))
+		if i:
+			self.dgram_socket.send(i, ['FIND', hash, peerid, transid])
+			return
 		# if we can't find a node less than the key,
 		# then our successor (or just us) must be its owner
 		if self.finger[0]:
-			self.dgram_socket.send(peerid, ['FOUND', hash, self.finger[0], transid])
+			self.dgram_socket.send(peerid, ['FOUND', hash, self.finger[0], transid] + self.successors()[1:])
 		else:
 			self.dgram_socket.send(peerid, ['FOUND', hash, self.myname, transid])
 
@@ -364,53 +1742,83 @@ class Main:
 		s = StreamSocket(sock, self)
 		(host, port) = peername.split(':')
 		s.connect(host, port)
+		s.upgrade()
 		return s
 
 	#
 	# timers
 	#
 	def reschedule(self, name, func, time):
-		self.timers[name] = Timer(10, func)
+		self.timers[name] = Timer(time, func)
 		self.timers[name].add()
 
 	def ping_timer_cb(self):
-		# reschedule
-		self.reschedule('ping', self.ping_timer_cb, 10)
+		now = time.time()
+		peers = set(self.finger.peers() + [self.prev])
+		peers.discard(None)
+		peers.discard(self.myname)
+		dead = set()
+		pinged = suspect = False
+		for x in peers:
+			# a peer we've never heard from gets counted from now
+			heard = self.heard.setdefault(x, now)
+			if now - heard <= self.interval:
+				self.probes.pop(x, None)
+				continue
+			p = self.probes.get(x)
+			if not p or p[0] != heard:
+				p = self.probes[x] = [heard, 0, 0]
+			if p[1] >= PROBES:
+				if now - p[2] > self.rtt(x).timeout():
+					dead.add(x)
+				continue
+			if p[1] > 0:
+				suspect = True
+			self.dgram_socket.send(x, ['PING', self.myname, '%.6f' % now])
+			p[1] += 1
+			p[2] = now
+			pinged = True
 
-		# look for dead nodes
 		# prev
-		if self.prev and self.prev in self.ping_fail and self.ping_fail[self.prev] >= 2:
+		if self.prev in dead:
 			print 'prev node %s failed, setting to none' % self.prev
 			self.prev = None
 		# finger[0]
-		if self.finger[0] and self.finger[0] in self.ping_fail and self.ping_fail[self.finger[0]] >= 2:
+		if self.finger[0] in dead:
 			print 'finger[0] (%s) died, updating with succsucc' % self.finger[0]
 			self.finger[0] = self.succsucc
 			self.succsucc = None
 		# fingers
-		for i in range(1, len(self.finger)):
-			if self.finger[i] and self.finger[i] in self.ping_fail and self.ping_fail[self.finger[i]] >= 2:
-				print 'finger %d (%s) failed, setting to none' % (i, self.finger[i])
+		for x in dead:
+			for i in self.finger.slots_of(x):
+				if i == 0:
+					continue # finger[0] was dealt with above
+				print 'finger %d (%s) failed, setting to none' % (i, x)
 				self.finger[i] = None
+			# no point keeping connections to dead peers
+			self.pool.drop(x)
+			self.owner_cache.forget(x)
+			self.heard.pop(x, None)
+			self.probes.pop(x, None)
+			self.rtts.pop(x, None)
 		# don't need to check deadness of succsucc; it gets refreshed automatically
 
-		# send heartbeat (dead nodes detected by timeout)
-		new_ping_fail = {}
-
-		for x in (self.finger + [self.prev]):
-			if not x:
-				continue # if x is none, just ignore
-			elif x in new_ping_fail:
-				pass # peer is in multiple finger slots; only ping once
-			else:
-				new_ping_fail[x] = self.ping_fail.get(x, 0) + 1
-				self.dgram_socket.send(x, ['PING', self.myname])
-
-		self.ping_fail = new_ping_fail
+		# probe quickly while the ring around us is changing, and back off
+		# while it's not
+		view = (self.finger[0], self.prev, tuple(self.succs))
+		if dead or view != self.view:
+			self.interval = PROBE_MIN
+		elif not suspect:
+			self.interval = min(self.interval * 1.5, PROBE_MAX)
+		self.view = view
+		if pinged:
+			self.reschedule('ping', self.ping_timer_cb, PROBE_MIN)
+		else:
+			self.reschedule('ping', self.ping_timer_cb, self.interval)
 
 	# periodically refresh succsucc
 	def backup_timer_cb(self):
-		self.reschedule('backup', self.backup_timer_cb, 10)
+		self.reschedule('backup', self.backup_timer_cb, self.interval)
 
 		if not self.finger[0] and self.succsucc:
 			print 'succ is null, copying succsucc %s to finger[0]' % self.succsucc
@@ -423,22 +1831,37 @@ class Main:
 		# query for succsucc again
 		t = Trans(Trans.BACKUP, self)
 		t.add()
-		self.find(add_to_id(make_id(self.finger[0]), 1), t.id)
+		self.find(format_id(add_to_id(node_id(self.finger[0]), 1)), t.id)
 
 	def finger_timer_cb(self):
-		self.reschedule('finger', self.finger_timer_cb, 15)
+		self.reschedule('finger', self.finger_timer_cb, self.interval * 1.5)
+
+		# check over the run of slots holding whichever finger has gone
+		# longest without being checked, in case peers have joined inside it
+		i = self.finger.stale()
+		for (first, last) in self.finger.runs():
+			if first <= i <= last:
+				self.find_finger(i, last)
 
-		# pick a random finger index and update it
-		# only use top 8 bits of hash; we don't have anywhere close to 2^160 nodes
-		index = random.randrange(len(self.finger)-8, len(self.finger))
-		t = Trans(Trans.FINGER, self, index)
+	def find_finger(self, index, end=None):
+		t = Trans(Trans.FINGER, self, index, end)
 		t.add()
-		self.find(add_to_id(make_id(self.myname), 2 ** index), t.id)
+		self.find(format_id(add_to_id(self.my_id, 2 ** index)), t.id)
+
+	# fill in the whole finger table, e.g. when we've just joined. slots next
+	# to each other mostly hold the same peer, so rather than a lookup per
+	# slot there's one per run of slots, all at once; each lookup settles the
+	# slots up to the peer it finds, and carries on from there if that's
+	# short of the end of its run
+	def build_fingers(self):
+		for (first, last) in self.finger.runs():
+			self.find_finger(first, last)
 
 	def stabilize_timer_cb(self):
-		self.reschedule('stabilize', self.stabilize_timer_cb, 10)
+		self.reschedule('stabilize', self.stabilize_timer_cb, self.interval)
 
 		self.dgram_socket.send(self.finger[0], ['GETP', self.myname])
+		self.dgram_socket.send(self.finger[0], ['GETS', self.myname])
 
 		# according to paper, we should wait to notify until after we update
 		# our successor from succ.prev, but we may not get a reply if they have
@@ -461,6 +1884,228 @@ class Main:
 		file = random.choice(self.items.keys())
 		self.find(file, t.id)
 
+# stands in for a connection that a worker process accepted and is relaying
+# to us, so Main's handlers can treat it like any other socket
+class RelaySocket:
+	def __init__(self, main, chan, connid):
+		self.main = main
+		self.chan = chan
+		self.connid = connid
+		self.msg = None # message currently being handled
+		self.stopped = False # the worker's connection to the client has backed up (PAUSE)
+
+	# backed up here or at the worker; see Main.on_resume for when it clears
+	@property
+	def paused(self):
+		return self.stopped or self.chan.paused
+
+	def __str__(self):
+		return 'relay-%s' % self.connid
+
+	def next_msg(self, data):
+		return (1, self.msg)
+
+	def write(self, data):
+		self.chan.write(['RELAY', self.connid] + data, relay_vpos(data))
+
+	def close_when_done(self):
+		if self.main.relays.pop((self.chan, self.connid), None):
+			self.chan.write(['CLOSE', self.connid])
+
+	def close(self):
+		self.close_when_done()
+
+# runs in a worker process (see Manager.spawn_workers). accepts connections on
+# the shared listen port and handles CGET/CPUT itself, only asking the
+# coordinator to do the ring lookup; anything else is relayed to the
+# coordinator, which owns the ring state and the items
+class Worker:
+	def __init__(self):
+		self.DEBUG = False
+
+	def start(self, options):
+		self.myname = options['listen_addr']
+		self.coord = options['coord_sock']
+		self.listen_sock = options['listen_sock']
+		self.pending = {} # request id -> [Trans type, client socket, data for PUT or codecs the client takes for GET, hash, replicas left to try, owner socket]
+		self.deadlines = [] # heap of (deadline, request id), as in TransTable
+		self.schedule()
+		self.pool = ConnPool(self)
+		self.cache = ValueCache()
+		self.reported = None # cache counts last sent to the coordinator
+		self.relayed = {} # connid -> socket we're relaying to the coordinator
+		self.next = 0 # for request ids and connids
+		self.coord.binary = True # internal, so no need to negotiate
+		self.coord.stop_reads = False # see Main.start
+
+	def on_connect(self, socket):
+		socket.values = VALUE_ARG
+		socket.connid = None # set once we relay something from it
+
+	def schedule(self):
+		self.timer = Timer(TransTable.SWEEP, self.sweep)
+		self.timer.add()
+
+	# give up on requests whose lookup or owner never answered, so they can't
+	# hold on to their clients and data forever; and keep the coordinator's
+	# copy of our cache counts up to date for STATS
+	def sweep(self):
+		self.schedule()
+		counts = self.cache.counts()
+		if counts != self.reported:
+			self.coord.write(['VCACHE', str(os.getpid())] + [str(i) for i in counts])
+			self.reported = counts
+		now = time.time()
+		while self.deadlines and self.deadlines[0][0] <= now:
+			reqid = heapq.heappop(self.deadlines)[1]
+			req = self.pending.pop(reqid, None)
+			if req:
+				print 'request %s timed out' % reqid
+				req[1].write(['CERROR', 'timeout'])
+				self.finish(req[1])
+
+	# let the coordinator know when a connection it's writing to backs up, so
+	# it can stop (see RelaySocket)
+	def on_pause(self, socket):
+		if socket.connid in self.relayed:
+			self.coord.write(['PAUSE', socket.connid])
+
+	def on_resume(self, socket):
+		if socket.connid in self.relayed:
+			self.coord.write(['RESUME', socket.connid])
+
+	# we're done with socket; tell the coordinator, if it's been relaying
+	# for it, so connids aren't left behind
+	def unrelay(self, socket):
+		if self.relayed.pop(socket.connid, None):
+			self.coord.write(['CLOSE', socket.connid])
+
+	# close client once what it's been sent has gone
+	def finish(self, client):
+		self.unrelay(client)
+		client.close_when_done()
+
+	def on_error(self, socket):
+		if socket == self.coord:
+			sys.exit('lost connection to coordinator')
+		self.unrelay(socket)
+		self.pool.discard(socket)
+		for (reqid, req) in self.pending.items():
+			if req[1] == socket:
+				del self.pending[reqid]
+			elif req[5] == socket:
+				# lost the owner
+				del self.pending[reqid]
+				req[1].write(['CERROR', 'peer.failed'])
+				self.finish(req[1])
+
+	def on_data(self, socket, data):
+		(ret, args) = socket.next_msg(data)
+		if not args: # incomplete, or nothing for us to do
+			return ret
+
+		if self.DEBUG: print 'inW:', ' '.join(args)
+		self.pool.touch(socket)
+
+		if socket == self.coord:
+			self.on_coord(args)
+		elif args[0] == 'CGET':
+			hit = self.cache.get(args[1])
+			if hit:
+				socket.write(['CDATA'] + client_value(hit[1], hit[0], args[2:]))
+				self.finish(socket)
+			else:
+				self.lookup(args[1], Trans.GET, socket, args[2:])
+		elif args[0] == 'CPUT':
+			self.lookup(make_file_id(args[1]), Trans.PUT, socket, pack(args[1], COMPRESS))
+		elif args[0] in ('DATA', 'ERROR', 'OK') and args[-1] in self.pending:
+			req = self.pending[args[-1]]
+			if args[0] == 'ERROR' and req[0] == Trans.GET and req[4]:
+				# maybe another replica has it
+				req[5] = self.pool.get(req[4].pop(0))
+				req[5].write(['GET', req[3], args[-1]])
+				return ret
+			# reply from an owner; pass it on as CDATA/CERROR/COK
+			del self.pending[args[-1]]
+			client = req[1]
+			if args[0] == 'DATA':
+				self.cache.add(req[3], args[2], args[1])
+				client.write(['CDATA'] + client_value(args[1], args[2], req[2]))
+			else:
+				client.write(['C' + args[0]] + args[1:-1])
+			self.finish(client)
+		elif socket in self.pool.peers:
+			pass # reply to a request whose client has gone away
+		else:
+			if args[0] == 'POOL':
+				no_delay(socket)
+			if socket.connid is None:
+				socket.connid = str(self.next)
+				self.next += 1
+			self.relayed[socket.connid] = socket
+			self.coord.write(['RELAY', socket.connid] + args, relay_vpos(args))
+
+		return ret
+
+	def lookup(self, hash, type, client, data):
+		reqid = '%s-w%d-%d' % (self.myname, os.getpid(), self.next)
+		self.next += 1
+		self.pending[reqid] = [type, client, data, hash, [], None]
+		heapq.heappush(self.deadlines, (time.time() + Trans.DEADLINES[type], reqid))
+		self.coord.write(['LOOKUP', hash, reqid])
+
+	# messages from the coordinator (see Main.on_worker)
+	def on_coord(self, args):
+		if args[0] == 'FOUND':
+			(hash, peer, reqid) = args[1:4]
+			if reqid not in self.pending:
+				return # client went away
+			req = self.pending[reqid]
+			req[4] = args[4:]
+			(type, data) = (req[0], req[2])
+			s = req[5] = self.pool.get(peer)
+			if type == Trans.GET:
+				s.write(['GET', hash, reqid])
+			else:
+				s.write(['PUT', data[1], data[0], reqid])
+		elif args[0] == 'FAIL':
+			(reqid, msg) = args[1:]
+			if reqid in self.pending:
+				client = self.pending.pop(reqid)[1]
+				client.write(['CERROR', msg])
+				self.finish(client)
+		elif args[0] == 'RELAY':
+			if args[1] in self.relayed:
+				self.relayed[args[1]].write(args[2:])
+		elif args[0] == 'CLOSE':
+			if args[1] in self.relayed:
+				self.relayed.pop(args[1]).close_when_done()
+		else:
+			print 'unknown message from coordinator:', ' '.join(args)
+
+	def connect(self, peername):
+		s = StreamSocket(socket.socket(), self)
+		(host, port) = peername.split(':')
+		s.connect(host, port)
+		s.upgrade()
+		return s
+
+# pooled connections carry small requests and replies back and forth, which
+# is the worst case for Nagle's algorithm meeting delayed ACKs (each reply
+# can sit 40ms waiting for the ACK of the last one); switch it off for them
+def no_delay(s):
+	s.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+# args for a CDATA of data, compressed with codec, to a client that can take
+# the codecs given. it gets the value as it is if it can, and uncompressed
+# if it can't
+def client_value(data, codec, codecs):
+	if codec == RAW:
+		return [data]
+	if codec in codecs:
+		return [data, codec]
+	return [unpack(codec, data)]
+
 # utility functions (these are all pure functions, so we make them freestanding)
 def make_id(addr):
 	h = hashlib.sha1()
@@ -473,30 +2118,39 @@ def make_file_id(addr): # make file ids differently to avoid collisions
 	h.update(addr)
 	return h.hexdigest()
 
+# ids on the ring are handled as integers; they're hex strings only on the wire
+RING_SIZE = 2 ** 160
+
+def parse_id(s):
+	return long(s, 16)
+def format_id(n):
+	return '%040x' % n
+
+# id of the peer at addr. we need these all the time when routing, so
+# remember them rather than hashing again (there aren't many peers)
+node_ids = {}
+def node_id(addr):
+	if addr not in node_ids:
+		node_ids[addr] = parse_id(make_id(addr))
+	return node_ids[addr]
+
 # returns hash distance from id1 to id2
 def id_distance(id1, id2):
 	if id1 == id2:
 		# special case: if we're the only node, we need to have the distance
 		# to our successor be maximum for forwarding to work correctly;
 		# so if they're the same, the distance is 2^160
-		return 2 ** 160
-	l1 = long(id1, 16)
-	l2 = long(id2, 16)
-	if l1 > l2:
-		return 2 ** 160 + l2 - l1
-	else:
-		return l2 - l1
+		return RING_SIZE
+	return (id2 - id1) % RING_SIZE
 
 def add_to_id(id, n):
-	n = long(n)
-	id = long(id, 16)
-	sum = (id + n) & (2**160 - 1)
-	return '%040x' % (id + n)
+	return (id + n) % RING_SIZE
 
 if __name__ == '__main__':
-	if len(sys.argv) != 3:
-		sys.exit("Usage: %s myhost server" % sys.argv[0])
+	if len(sys.argv) not in (3, 4):
+		sys.exit("Usage: %s myhost server [workers]" % sys.argv[0])
 	host = sys.argv[1]
 	server = sys.argv[2]
-	m = Manager(Main(), host, server)
+	workers = len(sys.argv) == 4 and int(sys.argv[3]) or 0
+	m = Manager(Main(), host, server, workers)
 	m.run()
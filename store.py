@@ -0,0 +1,359 @@
+# storage engines for the items a peer holds. they all act like a dict from
+# hash (hex string) to value, plus between() for walking a range of the
+# ring in order; pick one with open_store
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+# values can be kept compressed. each is stored along with the name of its
+# codec, RAW if it isn't compressed, and peers pass values to each other in
+# that form (see packed and put_packed); reading one with store[key]
+# decompresses it
+RAW = 'raw'
+DECOMPRESS = {'zlib': zlib.decompress}
+COMPRESS_MIN = 512 # smaller values aren't worth it
+COMPRESS_RATIO = 0.9 # keep the compressed form only if it's at most this fraction of the size
+
+def unpack(codec, data):
+	if codec == RAW:
+		return data
+	return DECOMPRESS[codec](str(data))
+
+# pick a store: persistent under path if given, otherwise in memory.
+# compress turns on compression of values as they're stored
+def open_store(path=None, compress=False):
+	if path:
+		return LogStore(path, compress)
+	return MemoryStore(compress)
+
+# (codec, data) to store value as
+def pack(value, compress):
+	if not compress or len(value) < COMPRESS_MIN:
+		return (RAW, value)
+	data = zlib.compress(str(value))
+	if len(data) > len(value) * COMPRESS_RATIO:
+		return (RAW, value)
+	return ('zlib', data)
+
+# keys in ring order. keys are fixed-width lowercase hex, so sorting them as
+# strings puts them in the same order as their ring positions, without
+# having to parse them
+class KeyIndex:
+	BATCH = 64 # keys to take at a time when walking a range
+
+	def __init__(self):
+		self.keys = []
+
+	def add(self, key):
+		i = bisect.bisect_left(self.keys, key)
+		if i == len(self.keys) or self.keys[i] != key:
+			self.keys.insert(i, key)
+
+	def remove(self, key):
+		i = bisect.bisect_left(self.keys, key)
+		if i < len(self.keys) and self.keys[i] == key:
+			del self.keys[i]
+
+	# generates keys strictly after low and before high, going around the ring
+	# from low (all but low itself, if they're equal). keys are looked up a
+	# batch at a time, so it's fine to change the index between batches
+	def between(self, low, high):
+		if low < high:
+			segments = [(low, high)]
+		else:
+			segments = [(low, None), (None, high)] # wraps around past the top
+		for (start, end) in segments:
+			cur = start
+			while True:
+				if cur is None:
+					i = 0
+				else:
+					i = bisect.bisect_right(self.keys, cur)
+				batch = self.keys[i:i+KeyIndex.BATCH]
+				if len(batch) == 0:
+					break
+				for key in batch:
+					if end is not None and key >= end:
+						break
+					yield key
+				else:
+					cur = batch[-1]
+					continue
+				break
+
+# plain in-memory store; everything is lost when the peer stops
+class MemoryStore(dict):
+	def __init__(self, compress=False):
+		dict.__init__(self)
+		self.order = KeyIndex()
+		self.compress = compress
+		self.codecs = {} # key -> codec, for values that are compressed
+
+	def __getitem__(self, key):
+		return unpack(self.codecs.get(key, RAW), dict.__getitem__(self, key))
+
+	def __setitem__(self, key, value):
+		self.put_packed(key, *self.pack(value))
+
+	def pack(self, value):
+		return pack(value, self.compress)
+
+	# (codec, data) as stored
+	def packed(self, key):
+		return (self.codecs.get(key, RAW), dict.__getitem__(self, key))
+
+	def put_packed(self, key, codec, data):
+		if key not in self:
+			self.order.add(key)
+		dict.__setitem__(self, key, data)
+		if codec == RAW:
+			self.codecs.pop(key, None)
+		else:
+			self.codecs[key] = codec
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.codecs.pop(key, None)
+		self.order.remove(key)
+
+	def between(self, low, high):
+		return self.order.between(low, high)
+
+	def writer(self):
+		return MemoryWriter(self)
+
+	def close(self):
+		pass
+
+# takes a value a piece at a time and stores it under key on commit(); the
+# key isn't known up front, since it's the hash of the whole value. values
+# built this way are big, so they're kept raw, where they can be streamed
+# out a piece at a time
+class MemoryWriter:
+	def __init__(self, store):
+		self.store = store
+		self.pieces = []
+
+	def write(self, data):
+		self.pieces.append(str(data))
+
+	def commit(self, key):
+		self.store.put_packed(key, RAW, ''.join(self.pieces))
+		self.pieces = []
+
+	def abort(self):
+		self.pieces = []
+
+# persistent store. values are appended to a data log and read back through
+# mmap, so they aren't copied onto the heap when served; an index log records
+# where each one is. files are kept in a directory:
+# current -- generation number of the files in use
+# data.N -- values, back to back
+# index.N -- RECORDs; replayed on open to rebuild the in-memory index
+# deleted values are dead space in the data log until it's compacted
+class LogStore:
+	RECORD = struct.Struct('!B40sQI') # op, key, offset, length
+	PUT = 1
+	DELETE = 2
+	PUT_ZLIB = 3 # like PUT, for a value compressed with zlib
+	COMPACT_MIN = 1 << 20 # don't bother compacting less dead space than this
+	OPS = {RAW: PUT, 'zlib': PUT_ZLIB} # op to store a value with each codec
+	CODECS = {PUT: RAW, PUT_ZLIB: 'zlib'}
+
+	def __init__(self, path, compress=False):
+		self.path = path
+		self.compress = compress
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		try:
+			self.gen = int(open(os.path.join(path, 'current')).read())
+		except IOError:
+			self.gen = 0
+		self.open_files()
+
+	def filename(self, name, gen):
+		return os.path.join(self.path, '%s.%d' % (name, gen))
+
+	def open_files(self):
+		self.data = os.open(self.filename('data', self.gen), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+		self.index_fd = os.open(self.filename('index', self.gen), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+		self.size = os.fstat(self.data).st_size # end of the data log
+		self.map = None
+		self.mapped = 0 # how much of the data log self.map covers
+		self.index = {} # key -> (offset, length, codec)
+		self.dead = 0 # bytes of the data log no longer referenced
+		self.replay()
+		self.order = KeyIndex()
+		for key in sorted(self.index.iterkeys()):
+			self.order.keys.append(key)
+
+	# rebuild the index from the index log. a crash can leave a partial record
+	# at the end, or records for data that never made it out; drop those
+	def replay(self):
+		raw = os.read(self.index_fd, os.fstat(self.index_fd).st_size)
+		size = LogStore.RECORD.size
+		good = 0
+		for pos in xrange(0, len(raw) - size + 1, size):
+			(op, key, offset, length) = LogStore.RECORD.unpack_from(raw, pos)
+			if op in LogStore.CODECS and offset + length <= self.size:
+				if key in self.index:
+					self.dead += self.index[key][1]
+				self.index[key] = (offset, length, LogStore.CODECS[op])
+			elif op == LogStore.DELETE and key in self.index:
+				self.dead += self.index.pop(key)[1]
+			else:
+				break
+			good = pos + size
+		if good != len(raw):
+			os.ftruncate(self.index_fd, good)
+
+	def log(self, op, key, offset, length):
+		os.write(self.index_fd, LogStore.RECORD.pack(op, key, offset, length))
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self, key):
+		return key in self.index
+
+	def __iter__(self):
+		return self.index.iterkeys()
+
+	def iterkeys(self):
+		return self.index.iterkeys()
+
+	def keys(self):
+		return self.index.keys()
+
+	def between(self, low, high):
+		return self.order.between(low, high)
+
+	# returns a read-only buffer into the data log, not a copy, unless the
+	# value has to be decompressed
+	def __getitem__(self, key):
+		return unpack(*self.packed(key))
+
+	# (codec, data) as stored; data is a buffer into the data log
+	def packed(self, key):
+		(offset, length, codec) = self.index[key]
+		return (codec, self.read(offset, length))
+
+	def read(self, offset, length):
+		if length == 0:
+			return '' # can't mmap an empty file
+		if offset + length > self.mapped:
+			# the log has grown since we mapped it. we don't close the old map:
+			# buffers handed out earlier may still be waiting to be sent, and
+			# it goes away by itself once they're gone
+			self.map = mmap.mmap(self.data, self.size, access=mmap.ACCESS_READ)
+			self.mapped = self.size
+		return buffer(self.map, offset, length)
+
+	def __setitem__(self, key, value):
+		self.put_packed(key, *self.pack(value))
+
+	def pack(self, value):
+		return pack(value, self.compress)
+
+	def put_packed(self, key, codec, data):
+		self.append(key, [data], codec)
+
+	# store the concatenation of pieces under key
+	def append(self, key, pieces, codec=RAW):
+		if key in self.index:
+			# keys are hashes of their values, so we already have this one
+			return
+		offset = self.size
+		for value in pieces:
+			written = 0
+			while written < len(value):
+				written += os.write(self.data, buffer(value, written))
+			self.size += len(value)
+		self.log(LogStore.OPS[codec], key, offset, self.size - offset)
+		self.index[key] = (offset, self.size - offset, codec)
+		self.order.add(key)
+
+	def writer(self):
+		return LogWriter(self)
+
+	def __delitem__(self, key):
+		(offset, length, codec) = self.index.pop(key)
+		self.order.remove(key)
+		self.log(LogStore.DELETE, key, offset, length)
+		self.dead += length
+		if self.dead > LogStore.COMPACT_MIN and self.dead > self.size / 2:
+			self.compact()
+
+	# copy live values to a new generation of files and switch over to it
+	def compact(self):
+		gen = self.gen + 1
+		for name in ('data', 'index'):
+			if os.path.exists(self.filename(name, gen)):
+				os.unlink(self.filename(name, gen))
+		data = os.open(self.filename('data', gen), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+		index = os.open(self.filename('index', gen), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+		offset = 0
+		for key in self.index.keys():
+			(codec, value) = self.packed(key)
+			written = 0
+			while written < len(value):
+				written += os.write(data, buffer(value, written))
+			os.write(index, LogStore.RECORD.pack(LogStore.OPS[codec], key, offset, len(value)))
+			offset += len(value)
+		os.fsync(data)
+		os.fsync(index)
+		os.close(data)
+		os.close(index)
+
+		# switching generations is a rename, so a crash leaves us on one or the other
+		tmp = os.path.join(self.path, 'current.tmp')
+		f = open(tmp, 'w')
+		f.write('%d' % gen)
+		f.close()
+		os.rename(tmp, os.path.join(self.path, 'current'))
+
+		old = self.gen
+		os.close(self.data)
+		os.close(self.index_fd)
+		self.gen = gen
+		self.open_files()
+		os.unlink(self.filename('data', old))
+		os.unlink(self.filename('index', old))
+
+	def close(self):
+		os.fsync(self.data)
+		os.fsync(self.index_fd)
+		os.close(self.data)
+		os.close(self.index_fd)
+		self.map = None
+
+# like MemoryWriter, but pieces wait in a temporary file next to the store
+# rather than in memory. several can be going at once, so they can't go
+# straight into the data log
+class LogWriter:
+	READ_SIZE = 65536
+
+	def __init__(self, store):
+		self.store = store
+		self.spool = tempfile.TemporaryFile(dir=store.path)
+
+	def write(self, data):
+		self.spool.write(data)
+
+	def pieces(self):
+		self.spool.seek(0)
+		while True:
+			data = self.spool.read(LogWriter.READ_SIZE)
+			if not data:
+				break
+			yield data
+
+	def commit(self, key):
+		self.store.append(key, self.pieces())
+		self.spool.close()
+
+	def abort(self):
+		self.spool.close()